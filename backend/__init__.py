@@ -2,6 +2,7 @@ from flask import Flask
 from flask_admin import Admin
 from flask_security import SQLAlchemyUserDatastore, Security
 
+from backend import metrics, timing
 from backend.database import db
 from backend.models import User, Role
 
@@ -10,6 +11,8 @@ app = Flask(__name__)
 app.config.from_pyfile('config.py')
 
 db.init_app(app)
+timing.init_app(app)
+metrics.init_app(app)
 
 # connecting to user data store
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
@@ -0,0 +1,152 @@
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from functools import wraps
+from hashlib import sha1
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event, inspect
+
+from backend.changes import LiveIndex
+from backend.database import db
+
+
+@event.listens_for(db.Model, 'load', propagate=True)
+def _on_load(obj, context):
+    # rows read while building a cacheable response are what it depends on, with their versions
+    if has_app_context():
+        rows = g.get('cache_rows')
+        if rows is not None:
+            rows[(inspect(obj).mapper.local_table.name, obj.id)] = obj.__dict__.get('updated_at')
+
+
+Entry = namedtuple('Entry', 'body etag last_modified rows tables')
+
+
+class ResponseCache(LiveIndex):
+    """LRU cache of response bodies, bounded by entry count and total size.
+
+    Every entry remembers the rows it was built from (as (table, id) pairs) and the tables
+    whose new rows would change it; a commit touching any of those evicts it, in every worker.
+    Its ETag and Last-Modified come from the versions (updated_at) of those rows and tables.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        super(ResponseCache, self).__init__(*db.Model.__subclasses__())
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rebuild()
+
+    def rebuild(self):
+        self.invalidations += len(getattr(self, '_entries', ()))
+        self._entries = OrderedDict()
+        self._by_row = {}
+        self._by_table = {}
+        self.size = 0
+
+    def update(self, changes):
+        keys = set()
+        for table, ids in changes.items():
+            keys.update(self._by_table.get(table, ()))
+            for _id in ids:
+                keys.update(self._by_row.get((table, _id), ()))
+
+        for key in keys:
+            self._discard(key)
+        self.invalidations += len(keys)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+        deps = [(self._by_row, row) for row in entry.rows] + [(self._by_table, table) for table in entry.tables]
+        for deps, dep in deps:
+            deps[dep].discard(key)
+            if not deps[dep]:
+                del deps[dep]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, body, rows, tables):
+        """Stores body built from rows ((table, id) -> updated_at), returns the entry."""
+        versions = sorted((table, _id, str(version)) for (table, _id), version in rows.items())
+        # a response built from an in-process index loads no rows, its tables have to version it
+        versions += [(table, self.version(table)) for table in sorted(tables)]
+        etag = sha1(repr((key, versions)).encode()).hexdigest()
+        last_modified = max((version for version in rows.values() if version is not None), default=None)
+        if tables:
+            # deleting a row leaves the newest version of a collection as it was
+            last_modified = datetime.utcnow()
+
+        entry = Entry(body, etag, last_modified, frozenset(rows), tables)
+        if len(body) > self.max_bytes:
+            return entry
+        if key in self._entries:
+            self._discard(key)
+
+        self._entries[key] = entry
+        self.size += len(body)
+        for row in rows:
+            self._by_row.setdefault(row, set()).add(key)
+        for table in tables:
+            self._by_table.setdefault(table, set()).add(key)
+
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+        return entry
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def cached(cache, models=()):
+    """Caches the successful responses of a GET view by endpoint and query arguments,
+    and answers conditional requests (If-None-Match, If-Modified-Since) with 304.
+
+    `models` are the ones whose new rows change the response, e.g. the listed model of a collection.
+    """
+    tables = {model.__table__.name for model in models}
+
+    def decorator(view):
+        @wraps(view)
+        def _view(*args, **kwargs):
+            cache.refresh()
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+
+            entry = cache.get(key)
+            if entry is None:
+                g.cache_rows = {}
+                response = view(*args, **kwargs)
+                rows, g.cache_rows = g.cache_rows, None
+                if response.status_code != 200:
+                    return response
+                entry = cache.put(key, response.get_data(), rows, tables)
+
+            # an unchanged resource is answered from the entry, nothing gets serialized
+            response = current_app.response_class(entry.body, mimetype='application/json')
+            response.set_etag(entry.etag)
+            response.last_modified = entry.last_modified
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+
+        return _view
+
+    return decorator
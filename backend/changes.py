@@ -0,0 +1,198 @@
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy import event, inspect
+
+from backend.database import db
+from backend.timing import timed
+
+
+# Every commit appends the ids of the rows it touched to one log file per table.
+# All gunicorn workers read the same files, so in-process indexes stay in step with
+# commits made by any worker, not only by their own.
+
+def _log_path(table):
+    directory = current_app.config['CHANGES_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, table + '.log')
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _rotate(path):
+    # readers notice the new inode and rebuild from scratch
+    tmp = '{}.{}'.format(path, os.getpid())
+    open(tmp, 'w').close()
+    os.replace(tmp, path)
+
+
+def reset_logs(tables):
+    """Starts the logs of `tables` over, so that everything built from them is rebuilt.
+    For changes made without the session, e.g. bulk loads."""
+    for table in tables:
+        _rotate(_log_path(table))
+
+
+def _add(changes, obj):
+    _id = getattr(obj, 'id', None)
+    if _id is not None:
+        changes.setdefault(inspect(obj).mapper.local_table.name, set()).add(_id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _after_flush(session, flush_context):
+    changes = session.info.setdefault('changes', {})
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        _add(changes, obj)
+
+        # rows on the other side of a changed relationship (or of a deleted row) change too,
+        # e.g. the buildings added to or removed from a style
+        deleted = obj in session.deleted
+        state = inspect(obj)
+        for relationship in state.mapper.relationships:
+            history = state.attrs[relationship.key].history
+            related = list(history.added or ()) + list(history.deleted or ())
+            if deleted:
+                related += list(history.unchanged or ())
+            for other in related:
+                if other is not None:
+                    _add(changes, other)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+
+    for table, ids in changes.items():
+        path = _log_path(table)
+
+        if _size(path) > current_app.config['CHANGES_LOG_MAX']:
+            _rotate(path)
+
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, ''.join('{}\n'.format(_id) for _id in ids).encode())
+        finally:
+            os.close(fd)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('changes', None)
+
+
+# the newest modification time of a log seen by any feed of this process
+_last_commit = [0.0]
+
+
+def last_commit():
+    """When the latest commit polled by this process was made, as a timestamp."""
+    return _last_commit[0]
+
+
+def chunked(ids, size=500):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+class ChangeFeed:
+    def __init__(self, tables):
+        self.tables = tables
+        self._positions = None
+
+    def reset(self):
+        self._positions = None
+
+    def position(self, table):
+        return self._positions[table]
+
+    def poll(self):
+        """Returns the ids committed to each table since the previous poll.
+
+        None means the history is unknown (first poll, or a log was rotated) and
+        whatever is built from these tables has to be rebuilt from scratch.
+        """
+        lost = self._positions is None
+        positions = {}
+        changes = {}
+
+        for table in self.tables:
+            path = _log_path(table)
+            known = None if lost else self._positions[table]
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o644))
+                stat = os.stat(path)
+            if stat.st_mtime > _last_commit[0]:
+                _last_commit[0] = stat.st_mtime
+
+            if known is not None and known == (stat.st_ino, stat.st_size):
+                positions[table] = known
+                continue
+
+            with open(path, 'rb') as f:
+                ino = os.fstat(f.fileno()).st_ino
+                if known is None or known[0] != ino:
+                    lost = True
+                    f.seek(0, os.SEEK_END)
+                    positions[table] = (ino, f.tell())
+                    continue
+
+                f.seek(known[1])
+                data = f.read()
+
+            # a line still being written is picked up by the next poll
+            end = data.rfind(b'\n') + 1
+            positions[table] = (ino, known[1] + end)
+            changes[table] = {int(line) for line in data[:end].split()}
+
+        self._positions = positions
+        return None if lost else changes
+
+
+class LiveIndex:
+    """Base for in-process structures derived from the rows of `models`.
+
+    Subclasses implement rebuild() and update(changes), where changes maps table names
+    to the ids committed since the last refresh; a row missing from the database was deleted.
+    """
+
+    def __init__(self, *models):
+        self.models = models
+        self._feed = ChangeFeed([model.__table__.name for model in models])
+        self._lock = threading.RLock()
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def update(self, changes):
+        raise NotImplementedError
+
+    def version(self, table):
+        """Position in the change log of `table` as of the last refresh, moving with every commit to it."""
+        return self._feed.position(table)
+
+    def refresh(self):
+        with self._lock:
+            try:
+                changes = self._feed.poll()
+                if changes is None:
+                    timed('index', self.rebuild)()
+                elif any(changes.values()):
+                    timed('index', self.update)(changes)
+            except Exception:
+                self._feed.reset()
+                raise
+        return self
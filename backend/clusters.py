@@ -0,0 +1,162 @@
+from math import cos, floor, log, pi, radians, tan
+
+from backend.changes import LiveIndex, chunked
+from backend.database import db
+
+TILE_SIZE = 256
+# deepest zoom of a tile, as deep as map clients go
+MAX_ZOOM = 30
+
+
+def project(lat, lon):
+    """Web Mercator position of the point, as fractions of the world map from the top left corner."""
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lon + 180) / 360
+    y = (1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2
+    return x, y
+
+
+class ClusterIndex(LiveIndex):
+    """Map marker clusters of the rows of `cls` for every zoom level up to `max_zoom`.
+
+    At zoom z the map is cut into square cells of `radius` pixels and all the points of a cell
+    make one cluster. A cell at zoom z is made of exactly four cells at zoom z + 1, so the points
+    are placed at max_zoom only once and every level above is summed up from the one below.
+    A cluster keeps its count and the sums of the coordinates (for the centroid); the ids of its
+    points are XOR-ed together, which gives the id of the only point of a cluster of one.
+    """
+
+    def __init__(self, cls, latitude, longitude, max_zoom, radius):
+        super(ClusterIndex, self).__init__(cls)
+        self.cls = cls
+        self.latitude = latitude
+        self.longitude = longitude
+        self.max_zoom = max_zoom
+        # cells across a tile
+        self.per_tile = max(TILE_SIZE // radius, 1)
+
+    def rebuild(self):
+        self.points = {}
+        self.levels = [{} for _ in range(self.max_zoom + 1)]
+        # ids of the points of every cell at max_zoom
+        self.members = {}
+        self._load()
+
+    def update(self, changes):
+        ids = changes.get(self.cls.__table__.name, ())
+        for _id in ids:
+            point = self.points.pop(_id, None)
+            if point is not None:
+                self._place(_id, point, -1)
+        for chunk in chunked(ids):
+            self._load(chunk)
+
+    def _cell(self, point, zoom):
+        cells = self.per_tile << zoom
+        x, y = project(*point)
+        return min(floor(x * cells), cells - 1), min(floor(y * cells), cells - 1)
+
+    def _load(self, ids=None):
+        query = db.session.query(self.cls.id, self.latitude, self.longitude)
+        if ids is not None:
+            query = query.filter(self.cls.id.in_(ids))
+
+        for _id, lat, lon in query:
+            if lat is None or lon is None:
+                continue
+            self.points[_id] = (lat, lon)
+            self._place(_id, (lat, lon), 1)
+
+    def _place(self, _id, point, sign):
+        x, y = self._cell(point, self.max_zoom)
+        ids = self.members.setdefault((x, y), set())
+        if sign > 0:
+            ids.add(_id)
+        else:
+            ids.discard(_id)
+            if not ids:
+                del self.members[(x, y)]
+        for zoom in range(self.max_zoom, -1, -1):
+            level = self.levels[zoom]
+            cluster = level.setdefault((x, y), [0, 0.0, 0.0, 0])
+            cluster[0] += sign
+            cluster[1] += sign * point[0]
+            cluster[2] += sign * point[1]
+            cluster[3] ^= _id
+            if not cluster[0]:
+                del level[(x, y)]
+            x, y = x >> 1, y >> 1
+
+    @staticmethod
+    def _clusters(clusters):
+        result = []
+        for count, lat, lon, ids in clusters:
+            cluster = {'latitude': lat / count, 'longitude': lon / count, 'count': count}
+            if count == 1:
+                cluster['id'] = ids
+            result.append(cluster)
+        return result
+
+    def tile(self, zoom, x, y):
+        """Returns the clusters of the map tile zoom/x/y."""
+        if zoom > MAX_ZOOM:
+            return []
+        if zoom > self.max_zoom:
+            return self._deep_tile(zoom, x, y)
+        level = self.levels[zoom]
+        keys = [
+            (cx, cy)
+            for cx in range(x * self.per_tile, (x + 1) * self.per_tile)
+            for cy in range(y * self.per_tile, (y + 1) * self.per_tile)
+        ]
+        return self._clusters(level[key] for key in keys if key in level)
+
+    def _deep_tile(self, zoom, x, y):
+        # the tile is a part of one at max_zoom: its cells lying inside keep their clusters,
+        # the ones it cuts through are cut down to their points inside it
+        shift = zoom - self.max_zoom
+        cells = self.per_tile << self.max_zoom
+        left, top = x / (1 << zoom), y / (1 << zoom)
+        right, bottom = (x + 1) / (1 << zoom), (y + 1) / (1 << zoom)
+
+        level = self.levels[self.max_zoom]
+        clusters = []
+        for cx in range((x >> shift) * self.per_tile, ((x >> shift) + 1) * self.per_tile):
+            for cy in range((y >> shift) * self.per_tile, ((y >> shift) + 1) * self.per_tile):
+                if (cx, cy) not in level:
+                    continue
+                if left <= cx / cells and (cx + 1) / cells <= right and \
+                        top <= cy / cells and (cy + 1) / cells <= bottom:
+                    clusters.append(level[(cx, cy)])
+                    continue
+
+                cluster = [0, 0.0, 0.0, 0]
+                for _id in self.members[(cx, cy)]:
+                    point = self.points[_id]
+                    px, py = project(*point)
+                    if left <= px < right and top <= py < bottom:
+                        cluster[0] += 1
+                        cluster[1] += point[0]
+                        cluster[2] += point[1]
+                        cluster[3] ^= _id
+                if cluster[0]:
+                    clusters.append(cluster)
+        return self._clusters(clusters)
+
+    def within(self, zoom, min_lat, min_lon, max_lat, max_lon):
+        """Returns the clusters of the cells overlapping the box."""
+        zoom = min(zoom, self.max_zoom)
+        level = self.levels[zoom]
+        min_x, min_y = self._cell((max_lat, min_lon), zoom)
+        max_x, max_y = self._cell((min_lat, max_lon), zoom)
+
+        if (max_x - min_x + 1) * (max_y - min_y + 1) < len(level):
+            keys = ((cx, cy) for cx in range(min_x, max_x + 1) for cy in range(min_y, max_y + 1))
+            clusters = (level[key] for key in keys if key in level)
+        else:
+            # a box larger than the populated area, fewer cells to look at this way
+            clusters = (
+                cluster for (cx, cy), cluster in level.items()
+                if min_x <= cx <= max_x and min_y <= cy <= max_y
+            )
+        return self._clusters(clusters)
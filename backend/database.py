@@ -1,3 +1,84 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+
+from backend.metrics import TimedQueuePool
+from backend.replicas import read_engine
+
+
+class PingingQueuePool(TimedQueuePool):
+    """Makes sure connections are alive when checked out, e.g. after PostgreSQL or a proxy restarted."""
+
+
+@event.listens_for(PingingQueuePool, 'checkout')
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # the pool drops the connection and checks out another one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """Reads from a replica when backend.replicas says so, unless changes were flushed in the transaction."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.info.get('flushed'):
+            engine = read_engine(self.db)
+            if engine is not None:
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['flushed'] = True
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('flushed', None)
+
+
+class SQLAlchemy(_SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_replica_engine(self, app, uri):
+        """An engine for `uri` set up like the one of the primary."""
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        rv = self.apply_driver_hacks(app, info, options)
+        if rv is not None:
+            info, options = rv
+        return create_engine(info, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        rv = super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        config = app.config
+        # SQLite is left with the pools picked by its dialect
+        if not info.drivername.startswith('sqlite'):
+            options.update(
+                poolclass=PingingQueuePool if config['DB_PRE_PING'] else TimedQueuePool,
+                pool_size=config['DB_POOL_SIZE'],
+                max_overflow=config['DB_MAX_OVERFLOW'],
+                pool_timeout=config['DB_POOL_TIMEOUT'],
+                pool_recycle=config['DB_POOL_RECYCLE'],
+            )
+        if info.drivername.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT']:
+            options.setdefault('connect_args', {})['options'] = '-c statement_timeout={:d}'.format(
+                config['DB_STATEMENT_TIMEOUT'])
+        return rv
+
 
 db = SQLAlchemy()
@@ -0,0 +1,386 @@
+import heapq
+from collections import Counter
+from itertools import accumulate, chain
+
+from sqlalchemy import func
+
+from backend.changes import LiveIndex, chunked
+from backend.database import db
+from backend.models import Building, District, building_architect, building_style
+
+# filters of every facet, the ones its counts leave out
+FACETS = {
+    'style': ('style',),
+    'architect': ('architect',),
+    'region': ('region',),
+    'district': ('district',),
+    'station': ('station',),
+    'decade': ('year_from', 'year_to'),
+}
+
+# filters taking ids, and years
+VALUES = ('style', 'architect', 'region', 'district', 'station')
+YEARS = ('year_from', 'year_to')
+# values counted by facet, decades being counted by start year
+COUNTED = ('style', 'architect', 'district', 'station', 'start')
+
+
+class FacetIndex(LiveIndex):
+    """Posting lists of the buildings by style, architect, district, metro station and construction years,
+    to filter by any of them at once and count the buildings of every value of every facet.
+
+    Values of one facet are alternatives (two styles mean either style) and facets narrow each other down.
+    The counts of a facet apply all the filters but its own, so that they tell what picking another value
+    of it would give. Regions are the districts they are made of, decades the years construction started in.
+
+    Counts are kept up to date for no filter (the sizes of the posting lists), for a single value of a facet
+    (or any values of a facet a building has one of) and for years alone, so that those cost the number
+    of values counted. Other filters cost the size of the smallest posting lists involved, their counts
+    the number of matches.
+    """
+
+    def __init__(self):
+        super(FacetIndex, self).__init__(Building, District)
+        self.columns = {
+            'district': Building.district_id,
+            'station': Building.station_id,
+            'start': Building.year_build_start,
+            'end': Building.year_build_end,
+        }
+        self.pairs = {
+            'style': (building_style.c.building_id, building_style.c.style_id),
+            'architect': (building_architect.c.building_id, building_architect.c.architect_id),
+        }
+
+    def rebuild(self):
+        self.ids = set()
+        self.max_id = 0
+        # name -> value of every building by id (None for no building, a tuple of values for pairs),
+        # which counts faster than dicts; name -> value -> building ids
+        self.values = {name: [] for name in list(self.columns) + list(self.pairs)}
+        self.postings = {name: {} for name in self.values}
+        # (name, value) -> name -> value -> count of the buildings having both
+        self.together = {}
+        # name -> value -> two lists of counts, of the buildings started and finished every year from first_year
+        self.years = {name: {} for name in COUNTED if name != 'start'}
+        # the same, adding up the years so far, made again when asked for after a change
+        self.running = None
+        self.first_year, self.span = db.session.query(func.min(Building.year_build_start),
+                                                      func.max(Building.year_build_end)).one()
+        self.span = 0 if self.first_year is None else self.span - self.first_year + 1
+        self._load_regions()
+        self._load()
+
+    def update(self, changes):
+        # buildings first, taken out of the regions they were counted in
+        ids = changes.get(Building.__table__.name, ())
+        for _id in ids:
+            self._remove(_id)
+        for chunk in chunked(ids):
+            self._load(chunk)
+
+        if changes.get(District.__table__.name):
+            self._load_regions()
+            self._count_regions()
+
+    def _load_regions(self):
+        self.region_of = dict(db.session.query(District.id, District.region_id))
+
+    def _count_regions(self):
+        # the counts of a region are the ones of its districts
+        for key in [key for key in self.together if key[0] == 'region']:
+            del self.together[key]
+        for (name, value), counts in list(self.together.items()):
+            if name == 'district':
+                region = self.together.setdefault(('region', self.region_of.get(value)),
+                                                  {other: Counter() for other in counts})
+                for other, counter in counts.items():
+                    region[other].update(counter)
+
+    def _load(self, ids=None):
+        query = db.session.query(Building.id, *self.columns.values())
+        if ids is not None:
+            query = query.filter(Building.id.in_(ids))
+
+        loaded = []
+        for row in query:
+            _id = row[0]
+            loaded.append(_id)
+            self.ids.add(_id)
+            self.max_id = max(self.max_id, _id)
+            values = dict(zip(self.columns, row[1:]))
+            # a building said to be finished before it was started is taken to be finished when started
+            values['end'] = max(values['start'], values['end'])
+            for name, value in values.items():
+                self._add(name, _id, value)
+
+        for name, (id_column, value_column) in self.pairs.items():
+            found = {_id: [] for _id in loaded}
+            query = db.session.query(id_column, value_column).filter(value_column.isnot(None))
+            if ids is not None:
+                query = query.filter(id_column.in_(ids))
+            for _id, value in query:
+                if _id in found:
+                    found[_id].append(value)
+            for _id, values in found.items():
+                self._add(name, _id, tuple(sorted(set(values))))
+
+        for _id in loaded:
+            self._count(_id, 1)
+
+    def _add(self, name, _id, value):
+        values = self.values[name]
+        if _id >= len(values):
+            values.extend([None] * (_id + 1 - len(values)))
+        values[_id] = value
+        for one in value if name in self.pairs else (value,):
+            self.postings[name].setdefault(one, set()).add(_id)
+
+    def _remove(self, _id):
+        if _id not in self.ids:
+            return
+        self._count(_id, -1)
+        self.ids.discard(_id)
+        for name, values in self.values.items():
+            removed, values[_id] = values[_id], None
+            for value in removed if name in self.pairs else (removed,):
+                posting = self.postings[name].get(value)
+                if posting is not None:
+                    posting.discard(_id)
+                    if not posting:
+                        del self.postings[name][value]
+
+    def _count(self, _id, change):
+        # adds the building to the kept counts, or takes it out of them
+        facets = [(name, value) for name in COUNTED
+                  for value in (self.values[name][_id] if name in self.pairs else (self.values[name][_id],))]
+        started = self._year(self.values['start'][_id])
+        finished = self._year(self.values['end'][_id])
+
+        for name, value in facets + [('region', self.region_of.get(self.values['district'][_id]))]:
+            if name == 'start':
+                continue
+            counts = self.together.get((name, value))
+            if counts is None:
+                counts = self.together[name, value] = {other: {} for other in COUNTED if other != name}
+            for other, one in facets:
+                if other != name:
+                    counter = counts[other]
+                    number = counter.get(one, 0) + change
+                    if number:
+                        counter[one] = number
+                    else:
+                        del counter[one]
+
+            if name == 'region':
+                continue
+            years = self.years[name].get(value)
+            if years is None:
+                years = self.years[name][value] = [0] * self.span, [0] * self.span
+            years[0][started] += change
+            years[1][finished] += change
+        self.running = None
+
+    def _year(self, year):
+        # index of the year in the lists of counts by year, made longer to take it if need be
+        if not self.span:
+            self.first_year, self.span = year, 1
+        elif year < self.first_year:
+            more = self.first_year - year
+            for years in self.years.values():
+                for counts in chain.from_iterable(years.values()):
+                    counts[:0] = [0] * more
+            self.first_year -= more
+            self.span += more
+        elif year >= self.first_year + self.span:
+            more = year - self.first_year - self.span + 1
+            for years in self.years.values():
+                for counts in chain.from_iterable(years.values()):
+                    counts.extend([0] * more)
+            self.span += more
+        return year - self.first_year
+
+    def _districts(self, regions):
+        return [district for district, region in self.region_of.items() if region in regions]
+
+    def _matching(self, name, wanted):
+        # building ids matching one filter, possibly a posting list itself: not to be changed
+        if name == 'region':
+            name, wanted = 'district', self._districts(wanted)
+        sets = [self.postings[name].get(value, ()) for value in wanted]
+        if len(sets) == 1:
+            return sets[0]
+        return set().union(*sets)
+
+    def _intersect(self, sets):
+        if not sets:
+            return None
+        sets = sorted(sets, key=len)
+        result = sets[0]
+        for other in sets[1:]:
+            result = result.intersection(other)
+        return result
+
+    def _in_years(self, filters):
+        # whether a building id is inside the year range of the filters
+        start, end = self.values['start'], self.values['end']
+        low, high = filters.get('year_from'), filters.get('year_to')
+        if low is not None and high is not None and low > high:
+            return lambda _id: False
+        return lambda _id: (low is None or end[_id] >= low) and (high is None or start[_id] <= high)
+
+    def _select(self, filters, matching):
+        """Ids of the buildings matching all `filters`, at least one of them not on years.
+        `matching` keeps the ids matching every filter across calls."""
+        for name in filters:
+            if name not in matching and name not in YEARS:
+                matching[name] = self._matching(name, filters[name])
+        ids = self._intersect([matching[name] for name in filters if name not in YEARS])
+
+        if not any(name in filters for name in YEARS):
+            return ids
+        # cheaper to look at the years of what the other filters let through than to gather all of a range
+        start, end = self.values['start'], self.values['end']
+        low, high = filters.get('year_from'), filters.get('year_to')
+        if low is not None and high is not None and low > high:
+            return set()
+        return {_id for _id in ids if (low is None or end[_id] >= low) and (high is None or start[_id] <= high)}
+
+    def _select_years(self, filters, limit):
+        """The count of the buildings in the year range of `filters` and their ids,
+        None instead of the ids when the first `limit` of them come soon counting up."""
+        low, high = filters.get('year_from'), filters.get('year_to')
+        if low is not None and high is not None and low > high:
+            return 0, set()
+
+        # started by the end of the range less finished before it begins, which were started by then too
+        started = [ids for year, ids in self.postings['start'].items() if high is None or year <= high]
+        finished = sum(len(ids) for year, ids in self.postings['end'].items() if low is not None and year < low)
+        count = sum(map(len, started)) - finished
+        if count ** 2 > limit * len(self.ids):
+            return count, None
+
+        sets = started
+        if low is not None and len(self.ids) - finished < count + finished:
+            # fewer finished from the beginning of the range on than started by its end
+            sets = [ids for year, ids in self.postings['end'].items() if year >= low]
+        return count, set(filter(self._in_years(filters), chain.from_iterable(sets)))
+
+    def _select_one(self, name, wanted, limit):
+        """The count of the buildings having one of the `wanted` values of a facet a building has one value of,
+        and their ids, None instead of the ids when the first `limit` of them come soon counting up."""
+        count = sum(len(self.postings[name].get(value, ())) for value in wanted)
+        if count ** 2 > limit * len(self.ids):
+            return count, None
+        return count, self._matching(name, wanted)
+
+    def _counts(self, name, names, filters, select):
+        """Counts of the values of `name` among the buildings matching the filters `names`,
+        `select` giving the ids of those buildings when there's nothing kept to count them from."""
+        values = [one for one in names if one not in YEARS]
+        if not names:
+            return {value: len(posting) for value, posting in self.postings[name].items()}
+
+        if not values:
+            low, high = filters.get('year_from'), filters.get('year_to')
+            if not self.span or low is not None and high is not None and low > high:
+                return {}
+            if self.running is None:
+                self.running = {one: {value: [[0] + list(accumulate(counts)) for counts in years]
+                                      for value, years in self.years[one].items()} for one in self.years}
+            low = 0 if low is None else min(max(low - self.first_year, 0), self.span)
+            high = self.span if high is None else min(max(high - self.first_year + 1, 0), self.span)
+            return {value: started[high] - finished[low] for value, (started, finished) in self.running[name].items()}
+
+        one = values[0] if len(names) == 1 else None
+        wanted = filters.get(one, ())
+        if one == name or (one, name) == ('region', 'district'):
+            return {value: len(self.postings[name].get(value, ()))
+                    for value in (self._districts(wanted) if one == 'region' else wanted)}
+        if one is not None and len(wanted) == 1:
+            value, = wanted
+            return self.together.get((one, value), {}).get(name, {})
+        if one is not None and one not in self.pairs:
+            # a building has a single one of the wanted values: the counts of each add up
+            counts = Counter()
+            for value in wanted:
+                counts.update(self.together.get((one, value), {}).get(name, {}))
+            return counts
+
+        ids = select()
+        values = self.values[name]
+        if name in self.pairs:
+            return Counter(chain.from_iterable(map(values.__getitem__, ids)))
+        return Counter(map(values.__getitem__, ids))
+
+    def _first(self, contains, limit, after):
+        # many matches: the first ones come soon counting up from after
+        page = []
+        for _id in range(0 if after is None else after + 1, self.max_id + 1):
+            if contains(_id):
+                page.append(_id)
+                if len(page) == limit:
+                    break
+        return page
+
+    def _page(self, ids, limit, after):
+        if len(ids) ** 2 > limit * len(self.ids):
+            return self._first(ids.__contains__, limit, after)
+        return heapq.nsmallest(limit, ids if after is None else (_id for _id in ids if _id > after))
+
+    def search(self, filters, limit, after=None):
+        """Filters (name -> set of values, or a year for year_from and year_to) the buildings.
+
+        Returns the ids of the first `limit` of them after the id `after`, their count,
+        and the counts of the values of every facet (facet -> [(value, count)], most common first).
+        """
+        matching = {}
+        selected = {}
+        if not filters:
+            count, page = len(self.ids), self._first(self.ids.__contains__, limit, after)
+        elif all(name in YEARS for name in filters):
+            count, ids = self._select_years(filters, limit)
+            if ids is None:
+                contains = self._in_years(filters)
+                page = self._first(lambda _id: _id in self.ids and contains(_id), limit, after)
+            else:
+                page = self._page(ids, limit, after)
+        elif len(filters) == 1 and not any(name in self.pairs for name in filters):
+            (name, wanted), = filters.items()
+            if name == 'region':
+                name, wanted = 'district', set(self._districts(wanted))
+            count, ids = self._select_one(name, wanted, limit)
+            if ids is None:
+                values = self.values[name]
+                page = self._first(lambda _id: values[_id] in wanted, limit, after)
+            else:
+                page = self._page(ids, limit, after)
+        else:
+            ids = selected[frozenset(filters)] = self._select(filters, matching)
+            count, page = len(ids), self._page(ids, limit, after)
+
+        def select(names):
+            if names not in selected:
+                selected[names] = self._select({name: filters[name] for name in names}, matching)
+            return selected[names]
+
+        counted = {}
+        facets = {}
+        for facet, own in FACETS.items():
+            names = frozenset(name for name in filters if name not in own)
+            name = {'region': 'district', 'decade': 'start'}.get(facet, facet)
+            if (name, names) not in counted:
+                counted[name, names] = self._counts(name, names, filters, lambda names=names: select(names))
+            counts = counted[name, names]
+
+            if facet in ('region', 'decade'):
+                folded = Counter()
+                for value, number in counts.items():
+                    folded[self.region_of.get(value) if facet == 'region' else value // 10 * 10] += number
+                folded.pop(None, None)
+                counts = folded
+
+            facets[facet] = sorted(((value, number) for value, number in counts.items() if number),
+                                   key=lambda item: (-item[1], item[0]))
+
+        return page, count, facets
@@ -1,6 +1,66 @@
+import os.path as op
+
+from flask_admin.form.upload import FileUploadField, ImageUploadField
 from wtforms.fields import TextAreaField
 from .widgets import CKTextAreaWidget
+from .images import delete_derivatives
+from .jobs import enqueue
+from .storage import content_name, find_processed, references, store
 
 
 class CKTextAreaField(TextAreaField):
     widget = CKTextAreaWidget()
+
+
+class ContentAddressedMixin:
+    """Stores uploads as they are, under the hash of their content, see backend/storage.py."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('namegen', lambda obj, file_data: content_name(file_data))
+        super(ContentAddressedMixin, self).__init__(*args, **kwargs)
+
+    def _save_file(self, data, filename):
+        data.stream.seek(0)
+        store(self._get_path(filename), data.save)
+        return filename
+
+    def _delete_file(self, filename):
+        # the same file may be the image of other rows
+        if references(filename) <= 1:
+            super(ContentAddressedMixin, self)._delete_file(filename)
+
+
+class DerivativesMixin:
+    """Has the resized copies of every uploaded image made in the background, see backend/jobs.py.
+
+    Their srcset ends up in the <name>_srcset column and the placeholder data of the image in <name>_meta,
+    which stay empty until then.
+    """
+
+    def populate_obj(self, obj, name):
+        key = name + '_srcset'
+        old = getattr(obj, name, None)
+        old_srcset = getattr(obj, key, None)
+        super(DerivativesMixin, self).populate_obj(obj, name)
+        new = getattr(obj, name, None)
+        if new == old:
+            return
+
+        # the copies go along with the original, which is kept while other rows use it
+        if old and not op.exists(self._get_path(old)):
+            delete_derivatives(old_srcset, self._get_path)
+
+        # a file uploaded before may have its copies already
+        processed = find_processed(new) if new else None
+        setattr(obj, key, processed and processed[0])
+        setattr(obj, name + '_meta', processed and processed[1])
+        if new and processed is None:
+            enqueue(obj, name, op.abspath(self._get_path('')))
+
+
+class DerivativesFileUploadField(DerivativesMixin, ContentAddressedMixin, FileUploadField):
+    pass
+
+
+class DerivativesImageUploadField(DerivativesMixin, ContentAddressedMixin, ImageUploadField):
+    pass
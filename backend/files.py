@@ -0,0 +1,104 @@
+import mimetypes
+import os
+import stat
+from datetime import datetime, timedelta
+
+from flask import abort, current_app, request
+from werkzeug.http import http_date, is_resource_modified, parse_date
+from werkzeug.security import safe_join
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import wrap_file
+
+
+def _read(f, length, chunk=64 * 1024):
+    try:
+        while length > 0:
+            data = f.read(min(chunk, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _range_applies(etag, last_modified):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == last_modified
+    return True
+
+
+def _satisfiable(range_, size):
+    # some range overlaps the file: starts before its end, or takes the last bytes of a file that has some
+    if range_.units != 'bytes':
+        return True
+    return any(start < size if start >= 0 else size > 0 for start, stop in range_.ranges)
+
+
+def send_image(directory, filename, accel_prefix=None, immutable=False):
+    """Responds with the file `filename` of `directory`.
+
+    With `accel_prefix`, the front server (nginx) is told to send the file itself from the internal location
+    `accel_prefix` + filename and the worker is done right away. Otherwise the response honours conditional and
+    Range requests, and the file goes out through wsgi.file_wrapper, which gunicorn turns into a sendfile() call.
+    `immutable` files are cached by clients for IMAGES_MAX_AGE without ever asking again.
+    """
+    path = safe_join(directory, filename)
+    try:
+        st = os.stat(path) if path is not None else None
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        abort(404)
+
+    response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+    if immutable:
+        max_age = current_app.config['IMAGES_MAX_AGE']
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+    else:
+        max_age = current_app.get_send_file_max_age(filename)
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    response.expires = datetime.utcnow() + timedelta(seconds=max_age)
+
+    if accel_prefix:
+        response.headers['X-Accel-Redirect'] = url_quote(accel_prefix + filename)
+        return response
+
+    size = st.st_size
+    etag = '{:x}-{:x}'.format(int(st.st_mtime * 1000), size)
+    last_modified = parse_date(http_date(st.st_mtime))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    start, stop = 0, size
+    if request.range is not None and _range_applies(etag, last_modified):
+        bounds = request.range.range_for_length(size)
+        if bounds is not None:
+            start, stop = bounds
+            response.status_code = 206
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        elif not _satisfiable(request.range, size):
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        # otherwise several ranges, which get the whole file
+
+    response.content_length = stop - start
+    if request.method == 'HEAD':
+        return response
+
+    f = open(path, 'rb')
+    f.seek(start)
+    # the file wrapper sends to the end of the file, which most ranges (resumed downloads) go to anyway
+    response.response = wrap_file(request.environ, f) if stop == size else _read(f, stop - start)
+    response.direct_passthrough = True
+    return response
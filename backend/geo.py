@@ -0,0 +1,137 @@
+import heapq
+from math import asin, cos, floor, radians, sin, sqrt
+
+from backend.changes import LiveIndex, chunked
+from backend.database import db
+
+EARTH_RADIUS = 6371000
+# metres in a degree of latitude
+DEGREE = EARTH_RADIUS * radians(1)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+class GeoIndex(LiveIndex):
+    """In-process grid over the coordinates of the rows of `cls`.
+
+    The map is cut into square cells of `cell` degrees, every cell holding the ids of the rows in it,
+    so a bounding box or a neighbourhood only looks at the cells it covers.
+    """
+
+    def __init__(self, cls, latitude, longitude, cell):
+        super(GeoIndex, self).__init__(cls)
+        self.cls = cls
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cell = cell
+
+    def rebuild(self):
+        self.points = {}
+        self.cells = {}
+        self._load()
+
+    def update(self, changes):
+        ids = changes.get(self.cls.__table__.name, ())
+        for _id in ids:
+            self._remove(_id)
+        for chunk in chunked(ids):
+            self._load(chunk)
+
+    def _key(self, lat, lon):
+        return floor(lat / self.cell), floor(lon / self.cell)
+
+    def _load(self, ids=None):
+        query = db.session.query(self.cls.id, self.latitude, self.longitude)
+        if ids is not None:
+            query = query.filter(self.cls.id.in_(ids))
+
+        for _id, lat, lon in query:
+            if lat is None or lon is None:
+                continue
+            self.points[_id] = (lat, lon)
+            self.cells.setdefault(self._key(lat, lon), set()).add(_id)
+
+    def _remove(self, _id):
+        point = self.points.pop(_id, None)
+        if point is None:
+            return
+        key = self._key(*point)
+        self.cells[key].discard(_id)
+        if not self.cells[key]:
+            del self.cells[key]
+
+    def within(self, min_lat, min_lon, max_lat, max_lon):
+        """Returns the ids of the points inside the box, sorted."""
+        (min_y, min_x), (max_y, max_x) = self._key(min_lat, min_lon), self._key(max_lat, max_lon)
+
+        if (max_y - min_y + 1) * (max_x - min_x + 1) < len(self.cells):
+            cells = (self.cells.get((y, x), ()) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1))
+        else:
+            # a box larger than the populated area, fewer cells to look at this way
+            cells = (ids for (y, x), ids in self.cells.items() if min_y <= y <= max_y and min_x <= x <= max_x)
+
+        result = []
+        for ids in cells:
+            for _id in ids:
+                lat, lon = self.points[_id]
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    result.append(_id)
+        result.sort()
+        return result
+
+    def nearest(self, lat, lon, k):
+        """Returns up to k (distance in metres, id) pairs closest to the point, nearest first."""
+        if not self.cells or k < 1:
+            return []
+
+        center_y, center_x = self._key(lat, lon)
+        ys = [y for y, _ in self.cells]
+        xs = [x for _, x in self.cells]
+        # every populated cell is at most this many rings away
+        last = max(abs(center_y - min(ys)), abs(center_y - max(ys)), abs(center_x - min(xs)), abs(center_x - max(xs)))
+        # metres of a degree of longitude, the shorter side of a cell
+        width = DEGREE * max(cos(radians(min(abs(lat) + self.cell, 90))), 0.01)
+
+        best = []
+
+        def add(ids):
+            for _id in ids:
+                item = (-distance(lat, lon, *self.points[_id]), -_id)
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+
+        for ring in range(last + 1):
+            # nothing beyond this ring can be closer than the k-th found so far
+            if len(best) == k and (ring - 1) * self.cell * width > -best[0][0]:
+                break
+            if (2 * ring + 1) ** 2 > len(self.cells):
+                # far from the points, most cells around are empty: the populated ones left are taken
+                # from the nearest on instead
+                cells = sorted((self._bound(lat, lon, y, x), y, x) for y, x in self.cells
+                               if max(abs(y - center_y), abs(x - center_x)) >= ring)
+                for bound, y, x in cells:
+                    if len(best) == k and bound > -best[0][0]:
+                        break
+                    add(self.cells[(y, x)])
+                break
+
+            for y in range(center_y - ring, center_y + ring + 1):
+                step = 1 if abs(y - center_y) == ring else 2 * ring
+                for x in range(center_x - ring, center_x + ring + 1, step or 1):
+                    add(self.cells.get((y, x), ()))
+
+        return [(-d, -_id) for d, _id in sorted(best, reverse=True)]
+
+    def _bound(self, lat, lon, y, x):
+        # no point of the cell is nearer than its centre less the distance from the centre to a corner
+        center_lat, center_lon = (y + 0.5) * self.cell, (x + 0.5) * self.cell
+        radius = max(distance(center_lat, center_lon, corner, x * self.cell)
+                     for corner in (y * self.cell, (y + 1) * self.cell))
+        return max(distance(lat, lon, center_lat, center_lon) - radius, 0)
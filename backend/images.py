@@ -0,0 +1,173 @@
+import math
+import os
+import os.path as op
+
+from PIL import Image
+
+# formats derivatives are saved in, best first, as (Pillow format, extension, mime type)
+FORMATS = (
+    ('WEBP', 'webp', 'image/webp'),
+    ('JPEG', 'jpg', 'image/jpeg'),
+)
+
+# EXIF orientation -> transpositions turning the image upright, the derivatives carry no EXIF
+_ORIENTATIONS = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_270, Image.FLIP_TOP_BOTTOM),
+    8: (Image.ROTATE_90,),
+}
+
+
+def _orientation(image):
+    try:
+        return image._getexif().get(0x0112)
+    except Exception:
+        return None
+
+
+def _formats():
+    Image.init()
+    return [f for f in FORMATS if f[0] in Image.SAVE]
+
+
+_BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+# sRGB value -> linear intensity
+_LINEAR = [v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4 for v in (i / 255 for i in range(256))]
+
+
+def _base83(value, length):
+    return ''.join(_BASE83[value // 83 ** (length - i) % 83] for i in range(1, length + 1))
+
+
+def _srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exp):
+    return math.copysign(abs(value) ** exp, value)
+
+
+def blurhash(image, x_components, y_components):
+    """The BlurHash (https://blurha.sh) of a small RGB image."""
+    width, height = image.size
+    pixels = [tuple(_LINEAR[c] for c in pixel) for pixel in image.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = cos_x[i][x] * cos_y[j][y]
+                    pixel = pixels[row + x]
+                    r += basis * pixel[0]
+                    g += basis * pixel[1]
+                    b += basis * pixel[2]
+            scale = (1 if i == j == 0 else 2) / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83(x_components - 1 + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = max(0, min(82, int(max(abs(c) for factor in ac for c in factor) * 166 - 0.5)))
+        maximum = (quantised_max + 1) / 166
+    else:
+        quantised_max = 0
+        maximum = 1
+    result += _base83(quantised_max, 1)
+    result += _base83((_srgb(dc[0]) << 16) + (_srgb(dc[1]) << 8) + _srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(_sign_pow(c / maximum, 0.5) * 9 + 9.5))) for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def describe(image, width, height):
+    """Placeholder data of an image: its size, its dominant colour and its BlurHash."""
+    small = image.convert('RGB')
+    small.thumbnail((32, 32), Image.BILINEAR)
+
+    quantized = small.quantize(8)
+    _, index = max(quantized.getcolors())
+    color = '#{:02x}{:02x}{:02x}'.format(*quantized.getpalette()[index * 3:index * 3 + 3])
+
+    components = (4, 3) if width >= height else (3, 4)
+    return {'width': width, 'height': height, 'color': color, 'blurhash': blurhash(small, *components)}
+
+
+def derivative_name(filename, width, extension):
+    return '{}.{}w.{}'.format(op.splitext(filename)[0], width, extension)
+
+
+def process_image(filename, get_path, widths, quality=80):
+    """Writes scaled down copies of an uploaded image next to it, `widths` wide, in every format of FORMATS.
+
+    `filename` is the name stored on the model and `get_path` turns such names into file paths.
+    Returns the srcset, a list of {'path', 'width', 'type'} narrowest first and ending with the original,
+    and the placeholder data made by describe(); both None for files that aren't raster images (SVGs).
+    """
+    # a missing file is an error, one that isn't an image isn't
+    with open(get_path(filename), 'rb') as f:
+        try:
+            image = Image.open(f)
+            original_type = Image.MIME.get(image.format)
+            orientation = _orientation(image)
+            # sizes are those of the upright image, as browsers show it
+            turned = orientation in (5, 6, 7, 8)
+            original_width, original_height = image.size[::-1] if turned else image.size
+            widths = sorted({w for w in widths if w < original_width}, reverse=True)
+            if widths:
+                # JPEGs are decoded straight at a fraction of their size when that's still wide enough
+                size = (widths[0], widths[0] * original_height // original_width)
+                image.draft('RGB', size[::-1] if turned else size)
+            image.load()
+        except (IOError, SyntaxError):
+            return None, None
+
+    for method in _ORIENTATIONS.get(orientation, ()):
+        image = image.transpose(method)
+    if image.mode not in ('RGB', 'RGBA'):
+        # palette and greyscale images can't be resampled smoothly
+        transparent = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if transparent else 'RGB')
+    formats = _formats()
+    srcset = []
+
+    # every width is scaled down from the previous one, which is much cheaper than from the original
+    for width in widths:
+        height = max(1, round(image.size[1] * width / image.size[0]))
+        image = image.resize((width, height), Image.LANCZOS)
+
+        for format, extension, mime in formats:
+            name = derivative_name(filename, width, extension)
+            copy = image.convert('RGB') if format == 'JPEG' and image.mode != 'RGB' else image
+            copy.save(get_path(name), format, quality=quality, optimize=format == 'JPEG', progressive=format == 'JPEG')
+            srcset.append({'path': name, 'width': width, 'type': mime})
+
+    # from the narrowest copy, there is no need for more detail
+    meta = describe(image, original_width, original_height)
+
+    # narrowest first, keeping the order of the formats
+    srcset.sort(key=lambda item: item['width'])
+    srcset.append({'path': filename, 'width': original_width, 'type': original_type})
+    return srcset, meta
+
+
+def delete_derivatives(srcset, get_path):
+    """Deletes the files of a srcset made by process_image, except for the original."""
+    for item in (srcset or [])[:-1]:
+        try:
+            os.remove(get_path(item['path']))
+        except OSError:
+            pass
@@ -0,0 +1,138 @@
+import os.path as op
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from functools import partial
+
+from sqlalchemy import event
+
+# commits of the runner have to reach the change logs like those of the web workers
+import backend.changes
+from backend.database import db
+from backend.images import delete_derivatives, process_image
+from backend.models import ImageJob
+from backend.storage import references
+
+
+# Uploads only queue a job in the database, so that admin saves don't wait for Pillow.
+# The jobs are run by a separate process (python -m backend.jobs) handing them out to a process pool;
+# until a job is done the srcset and placeholder data of the image stay empty and clients get the original.
+
+def enqueue(obj, column, base_path):
+    """Queues making the copies of the image just stored in `column` of `obj`, once obj is flushed."""
+    db.session.info.setdefault('image_jobs', []).append((obj, column, base_path))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _add_jobs(session, flush_context):
+    # new rows only get their ids here; the jobs are flushed right after, in the same transaction
+    for obj, column, base_path in session.info.pop('image_jobs', ()):
+        if obj in session.deleted or getattr(obj, column) is None:
+            continue
+        session.add(ImageJob(target_table=obj.__table__.name, target_id=obj.id, target_column=column,
+                             filename=getattr(obj, column), base_path=base_path))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('image_jobs', None)
+
+
+def _models():
+    return {cls.__table__.name: cls for cls in db.Model.__subclasses__()}
+
+
+def _claim(limit):
+    ids = [_id for _id, in db.session.query(ImageJob.id)
+           .filter(ImageJob.status == 'pending', ImageJob.run_after <= datetime.utcnow())
+           .order_by(ImageJob.run_after, ImageJob.id)
+           .limit(limit)]
+
+    # the status check makes claiming safe with several runners
+    claimed = [_id for _id in ids if ImageJob.query.filter_by(id=_id, status='pending').update(
+        {'status': 'running', 'attempts': ImageJob.attempts + 1}, synchronize_session=False)]
+    db.session.commit()
+
+    return ImageJob.query.filter(ImageJob.id.in_(claimed)).all() if claimed else []
+
+
+def _finish(job, srcset, meta):
+    obj = _models()[job.target_table].query.get(job.target_id)
+    if obj is None or getattr(obj, job.target_column) != job.filename:
+        # the row is gone or has got another image meanwhile; the copies may still be those of other rows
+        if not references(job.filename):
+            delete_derivatives(srcset, partial(op.join, job.base_path))
+    else:
+        setattr(obj, job.target_column + '_srcset', srcset)
+        setattr(obj, job.target_column + '_meta', meta)
+
+    job.status = 'done'
+    job.error = None
+    db.session.commit()
+
+
+def _fail(job, error, max_attempts, delay):
+    job.error = error
+    if job.attempts >= max_attempts:
+        job.status = 'failed'
+    else:
+        job.status = 'pending'
+        job.run_after = datetime.utcnow() + timedelta(seconds=delay * 2 ** (job.attempts - 1))
+    db.session.commit()
+
+
+def _start_pool(processes):
+    # all the processes are forked on the first submit, made here with no connection open so that they
+    # don't share one
+    db.session.remove()
+    db.engine.dispose()
+    pool = ProcessPoolExecutor(processes)
+    pool.submit(int).result()
+    return pool
+
+
+def run(app):
+    config = app.config
+    processes = config['JOBS_PROCESSES']
+    running = {}
+
+    with app.app_context():
+        pool = _start_pool(processes)
+
+        # jobs left running by a runner that was stopped are started over
+        ImageJob.query.filter_by(status='running').update({'status': 'pending'}, synchronize_session=False)
+        db.session.commit()
+
+        while True:
+            if len(running) < processes:
+                for job in _claim(processes - len(running)):
+                    future = pool.submit(process_image, job.filename, partial(op.join, job.base_path),
+                                         config['IMAGE_WIDTHS'], config['IMAGE_QUALITY'])
+                    running[future] = job.id
+
+            if not running:
+                time.sleep(config['JOBS_POLL_INTERVAL'])
+                continue
+
+            done, _ = wait(running, timeout=config['JOBS_POLL_INTERVAL'], return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job = ImageJob.query.get(running.pop(future))
+                try:
+                    srcset, meta = future.result()
+                except Exception as e:
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    _fail(job, repr(e), config['JOBS_MAX_ATTEMPTS'], config['JOBS_RETRY_DELAY'])
+                else:
+                    _finish(job, srcset, meta)
+
+            if broken:
+                # a process died (e.g. out of memory on a huge image), the pool can't be used anymore
+                pool.shutdown(wait=False)
+                pool = _start_pool(processes)
+
+
+if __name__ == '__main__':
+    from backend import app
+    run(app)
@@ -0,0 +1,281 @@
+import fcntl
+import json
+import os
+import threading
+from time import perf_counter, sleep
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Every process (gunicorn worker) keeps its metrics in memory and saves them every METRICS_FLUSH_INTERVAL
+# seconds to a file of its own, <pid>.json in METRICS_DIR. /metrics adds up the files of all processes
+# in the Prometheus text format. Counters and histograms of processes that are gone are merged into
+# dead.json, so that they keep growing across worker restarts; gauges only count live processes.
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+DEAD = 'dead.json'
+
+FAMILIES = {
+    'http_requests_total': (COUNTER, 'Requests by endpoint, method and status.'),
+    'http_request_duration_seconds': (HISTOGRAM, 'Time spent answering requests, by endpoint and method.'),
+    'http_requests_in_progress': (GAUGE, 'Requests being answered.'),
+    'worker_busy_seconds_total': (COUNTER, 'Time workers spent answering requests; its rate divided by '
+                                           'workers is their utilisation.'),
+    'workers': (GAUGE, 'Live worker processes that have answered requests.'),
+    'db_pool_checkout_seconds': (HISTOGRAM, 'Time waited for a database connection from the pool.'),
+    'db_pool_connections_in_use': (GAUGE, 'Database connections checked out of the pools.'),
+    'db_pool_capacity': (GAUGE, 'Database connections the pools may open, overflow included.'),
+    'response_cache_hits_total': (COUNTER, 'Responses served from the response cache.'),
+    'response_cache_misses_total': (COUNTER, 'Responses built because the response cache did not have them.'),
+    'response_cache_evictions_total': (COUNTER, 'Responses dropped from the response cache for room.'),
+    'response_cache_invalidations_total': (COUNTER, 'Responses dropped from the response cache by changes.'),
+    'response_cache_entries': (GAUGE, 'Responses in the response cache.'),
+    'response_cache_bytes': (GAUGE, 'Size of the responses in the response cache.'),
+}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """The metrics of this process, see FAMILIES. Labels are given as dicts."""
+
+    def __init__(self):
+        self.directory = None
+        self.interval = 1
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # name -> {labels: value}, histograms having [count per bucket..., count, sum]
+        self.values = {}
+        self.dirty = False
+        self._thread = None
+
+    def _series(self, name):
+        if self.pid != os.getpid():
+            # a forked worker starts from nothing
+            self._reset()
+        if self._thread is None and self.directory is not None:
+            self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._thread.start()
+        self.dirty = True
+        return self.values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            series = self._series(name)
+            key = _key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._series(name)[_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            series = self._series(name)
+            key = _key(labels)
+            if key not in series:
+                series[key] = [0] * (len(BUCKETS) + 2)
+            counts = series[key]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def collector(self, collect):
+        """Registers `collect`, called with this object before every save, e.g. to copy counts kept elsewhere."""
+        self.collectors.append(collect)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def flush(self):
+        for collect in self.collectors:
+            collect(self)
+
+        with self._lock:
+            data = {name: [[list(key), value] for key, value in series.items()]
+                    for name, series in self.values.items()}
+            self.dirty = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path('{}.json'.format(self.pid))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _flush_periodically(self):
+        while True:
+            sleep(self.interval)
+            if self.dirty:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    def _load(self, name):
+        try:
+            with open(self._path(name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {family: {tuple(map(tuple, key)): value for key, value in series}
+                for family, series in data.items()}
+
+    def _bury(self, dead):
+        # only one worker merges the files of dead ones at a time
+        with open(self._path('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = self._load(DEAD)
+            buried = []
+            for name in dead:
+                if not os.path.exists(self._path(name)):
+                    continue
+                _add(merged, self._load(name), gauges=False)
+                buried.append(name)
+            if not buried:
+                return
+            tmp = self._path(DEAD + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({family: [[list(key), value] for key, value in series.items()]
+                           for family, series in merged.items()}, f)
+            os.replace(tmp, self._path(DEAD))
+            for name in buried:
+                os.remove(self._path(name))
+
+    def collect(self):
+        """The sum of the metrics of all processes, {name: {labels: value}}."""
+        self.flush()
+
+        totals = {}
+        dead = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == DEAD:
+                continue
+            if not _alive(int(name[:-len('.json')])):
+                dead.append(name)
+                continue
+            _add(totals, self._load(name), gauges=True)
+
+        if dead:
+            self._bury(dead)
+        _add(totals, self._load(DEAD), gauges=False)
+        return totals
+
+    def render(self):
+        """The metrics of all processes in the Prometheus text format."""
+        lines = []
+        for name, series in sorted(self.collect().items()):
+            kind, text = FAMILIES.get(name, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for key, value in sorted(series.items()):
+                if kind != HISTOGRAM:
+                    lines.append('{}{} {}'.format(name, _labels(key), _number(value)))
+                    continue
+                for bound, count in zip(BUCKETS + ('+Inf',), value[:len(BUCKETS)] + [value[-2]]):
+                    lines.append('{}_bucket{} {}'.format(name, _labels(key + (('le', str(bound)),)), count))
+                lines.append('{}_count{} {}'.format(name, _labels(key), value[-2]))
+                lines.append('{}_sum{} {}'.format(name, _labels(key), _number(value[-1])))
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(totals, values, gauges):
+    for name, series in values.items():
+        kind = FAMILIES.get(name, (None,))[0]
+        if kind == GAUGE and not gauges:
+            continue
+        total = totals.setdefault(name, {})
+        for key, value in series.items():
+            if kind == HISTOGRAM:
+                total[key] = [a + b for a, b in zip(total.get(key, [0] * len(value)), value)]
+            else:
+                total[key] = total.get(key, 0) + value
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in key) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool reporting how long checkouts wait, and how many connections it may open."""
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super(TimedQueuePool, self).__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        metrics.set('db_pool_capacity', pool_size + max_overflow)
+
+    def connect(self):
+        started = perf_counter()
+        try:
+            return super(TimedQueuePool, self).connect()
+        finally:
+            metrics.observe('db_pool_checkout_seconds', perf_counter() - started)
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.inc('db_pool_connections_in_use')
+
+
+@event.listens_for(TimedQueuePool, 'checkin')
+def _checkin(dbapi_connection, connection_record):
+    metrics.inc('db_pool_connections_in_use', -1)
+
+
+def init_app(app):
+    metrics.directory = app.config['METRICS_DIR']
+    metrics.interval = app.config['METRICS_FLUSH_INTERVAL']
+
+    @app.before_request
+    def _start_request():
+        g.metrics_started = perf_counter()
+        metrics.set('workers', 1)
+        metrics.inc('http_requests_in_progress')
+
+    @app.after_request
+    def _count_request(response):
+        labels = {'endpoint': request.endpoint or 'none', 'method': request.method}
+        metrics.observe('http_request_duration_seconds', perf_counter() - g.metrics_started, **labels)
+        metrics.inc('http_requests_total', status=response.status_code, **labels)
+        return response
+
+    @app.teardown_request
+    def _end_request(exception):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            metrics.inc('http_requests_in_progress', -1)
+            metrics.inc('worker_busy_seconds_total', perf_counter() - started)
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+
+from backend.changes import LiveIndex
+from backend.database import db
+from backend.models import MetroRoute, MetroStation, station_route
+
+
+class MetroGraph(LiveIndex):
+    """The metro network in memory: the stations of every route and the routes of every station.
+
+    station_route doesn't keep the order of the stations along a route, so the stations of a route
+    are only the ones it serves, in id order. A station of several routes is where they meet (a transfer).
+    """
+
+    def __init__(self):
+        super(MetroGraph, self).__init__(MetroRoute, MetroStation)
+
+    def rebuild(self):
+        self._load_network()
+
+    def update(self, changes):
+        # a few hundred rows, cheaper to reload than to patch
+        self._load_network()
+
+    def _load_network(self):
+        routes = db.session.query(MetroRoute.id, MetroRoute.name, MetroRoute.color).order_by(MetroRoute.id).all()
+        stations = db.session.query(MetroStation.id, MetroStation.name, MetroStation.district_id) \
+            .order_by(MetroStation.id).all()
+        links = db.session.query(station_route.c.route_id, station_route.c.station_id) \
+            .order_by(station_route.c.route_id, station_route.c.station_id)
+
+        # route id -> station ids, station id -> route ids
+        self.route_stations = OrderedDict((_id, []) for _id, _, _ in routes)
+        self.station_routes = OrderedDict((_id, []) for _id, _, _ in stations)
+        for route, station in links:
+            stops = self.route_stations[route]
+            if not stops or stops[-1] != station:
+                stops.append(station)
+                self.station_routes[station].append(route)
+
+        self.transfers = [_id for _id, routes_ in self.station_routes.items() if len(routes_) > 1]
+        self.payload = {
+            'routes': [{'id': _id, 'name': name, 'color': color, 'stations': self.route_stations[_id]}
+                       for _id, name, color in routes],
+            'stations': [{'id': _id, 'name': name, 'district_id': district_id, 'routes': self.station_routes[_id]}
+                         for _id, name, district_id in stations],
+            'transfers': self.transfers,
+        }
@@ -1,22 +1,36 @@
+import json
+
 from backend import db
-from datetime import date
+from datetime import datetime
+from operator import attrgetter
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.types import TypeDecorator
 from flask_security import RoleMixin, UserMixin
 
+from backend.serializers import Serializer
+
+
+class JSONText(TypeDecorator):
+    impl = db.Text
+
+    def process_bind_param(self, value, dialect):
+        return json.dumps(value) if value is not None else None
 
-def dictonify(d: dict, exclude=None):
-    if exclude is None:
-        exclude = ['_sa_instance_state']
-    return {
-        k: v if not isinstance(v, date) else str(v) if v is not None else None
-        for k, v
-        in d.items()
-        if k not in exclude and not isinstance(v, list)
-    }
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value is not None else None
 
 
 class DictBase:
+    # version of the row, see _touch
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # set up at the bottom of the module, once all models are mapped
+    serializer = None
+
     def to_dict(self):
-        return dictonify(self.__dict__)
+        return self.serializer(self)
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -87,41 +101,33 @@ station_route = db.Table(
 
 
 class MetroRoute(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_metro_route_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     color = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'stations': [station.id for station in self.stations]
-        })
-        return result
-
     def __str__(self):
         return self.name
 
 
 class MetroStation(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_metro_station_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    routes = db.relationship('MetroRoute', secondary=station_route, backref=db.backref('stations', lazy='dynamic'))
+    routes = db.relationship('MetroRoute', secondary=station_route, backref=db.backref('stations'))
     district_id = db.Column(db.Integer, db.ForeignKey('district.id'), nullable=False)
     district = db.relationship('District', backref=db.backref('stations', lazy='dynamic'))
     description = db.Column(db.String, nullable=False)
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'routes': [route.id for route in self.routes]
-        })
-        return result
-
     def __str__(self):
         return self.name
 
 
 class District(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_district_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     region_id = db.Column(db.Integer, db.ForeignKey('region.id'), nullable=False)
@@ -133,6 +139,8 @@ class District(db.Model, DictBase):
 
 
 class Region(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_region_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     abbr = db.Column(db.String, nullable=False)
@@ -146,7 +154,10 @@ class BuildingImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     path = db.Column(db.String, nullable=False)
+    path_srcset = db.Column(JSONText)
+    path_meta = db.Column(JSONText)
     building_id = db.Column(db.Integer, db.ForeignKey('building.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __str__(self):
         return self.name + ': ' + self.path
@@ -166,6 +177,8 @@ class BuildingTextFact(db.Model, DictBase):
 
 
 class Building(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_building_title_id', 'title', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     title_info = db.Column(db.String)
@@ -177,12 +190,14 @@ class Building(db.Model, DictBase):
 
     architects = db.relationship('Architect',
                                  secondary=building_architect,
-                                 backref=db.backref('buildings', lazy='dynamic'))
+                                 backref=db.backref('buildings'))
     styles = db.relationship('Style',
                              secondary=building_style,
-                             backref=db.backref('buildings', lazy='dynamic'))
+                             backref=db.backref('buildings'))
 
     leading_img_path = db.Column(db.String, nullable=False)
+    leading_img_path_srcset = db.Column(JSONText)
+    leading_img_path_meta = db.Column(JSONText)
     images = db.relationship('BuildingImage', backref=db.backref('building'))
 
     text = db.Column(db.Text, nullable=False)
@@ -199,46 +214,6 @@ class Building(db.Model, DictBase):
     def __str__(self):
         return self.title
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'images': [
-                {
-                    'id': image.id,
-                    'name': image.name,
-                    'path': image.path
-                } for image in self.images
-            ],
-            'architects': [
-                {
-                    'id': architect.id,
-                    'name': architect.surname
-                } for architect in self.architects
-            ],
-            'styles': [
-                {
-                    'id': style.id,
-                    'name': style.name,
-                    'path': style.building_img_path,
-                } for style in self.styles
-            ],
-            'number_facts': [
-                {
-                    'id': fact.id,
-                    'number': fact.number,
-                    'name': fact.name
-                } for fact in self.number_facts
-            ],
-            'text_facts': [
-                {
-                    'id': fact.id,
-                    'text': fact.text
-                } for fact in self.text_facts
-            ]
-
-        })
-        return result
-
 
 class ArchitectFact(db.Model, DictBase):
     id = db.Column(db.Integer, primary_key=True)
@@ -248,6 +223,8 @@ class ArchitectFact(db.Model, DictBase):
 
 
 class Architect(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_architect_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     surname = db.Column(db.String, nullable=False)
@@ -258,42 +235,28 @@ class Architect(db.Model, DictBase):
     place_of_birth = db.Column(db.String, nullable=False)
     quote = db.Column(db.String, nullable=False)
     text = db.Column(db.Text, nullable=False)
-    styles = db.relationship('Style', backref=db.backref('architects', lazy='dynamic'), secondary=architect_style)
+    styles = db.relationship('Style', backref=db.backref('architects'), secondary=architect_style)
     img_path = db.Column(db.String)
+    img_path_srcset = db.Column(JSONText)
+    img_path_meta = db.Column(JSONText)
     square_img = db.Column(db.String)
+    square_img_srcset = db.Column(JSONText)
+    square_img_meta = db.Column(JSONText)
     portrait_img = db.Column(db.String)
+    portrait_img_srcset = db.Column(JSONText)
+    portrait_img_meta = db.Column(JSONText)
     landscape_img = db.Column(db.String)
+    landscape_img_srcset = db.Column(JSONText)
+    landscape_img_meta = db.Column(JSONText)
     facts = db.relationship('ArchitectFact', backref=db.backref('architect'))
 
     def __str__(self):
         return '{}, {} {}'.format(self.surname, self.name, self.patronymic)
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'styles': [
-                {
-                    'id': style.id,
-                    'name': style.name,
-                } for style in self.styles
-            ],
-            'buildings': [
-                {
-                    'id': building.id,
-                    'title': building.title,
-                    'title_info': building.title_info,
-                    'path': building.leading_img_path,
-                } for building in self.buildings
-            ],
-            'facts': [
-                fact.to_dict()
-                for fact in self.facts
-            ]
-        })
-        return result
-
 
 class Style(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_style_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     previous_id = db.Column(db.Integer, db.ForeignKey('style.id'))
@@ -304,49 +267,25 @@ class Style(db.Model, DictBase):
     text = db.Column(db.Text, nullable=False)
     fact = db.Column(db.String, nullable=False)
     building_img_path = db.Column(db.String, nullable=False)
+    building_img_path_srcset = db.Column(JSONText)
+    building_img_path_meta = db.Column(JSONText)
     door_handle_img_path = db.Column(db.String, nullable=False)
+    door_handle_img_path_srcset = db.Column(JSONText)
+    door_handle_img_path_meta = db.Column(JSONText)
     column_img_path = db.Column(db.String, nullable=False)
+    column_img_path_srcset = db.Column(JSONText)
+    column_img_path_meta = db.Column(JSONText)
     description = db.Column(db.String, nullable=False)
 
     def __str__(self):
         return self.name
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'following_id': self.following.id if self.following else None,
-            'architects': [
-                {
-                    'id': architect.id,
-                    'surname': architect.surname,
-                    'patronymic': architect.patronymic,
-                    'name': architect.name,
-                    'path': architect.img_path
-                } for architect in self.architects],
-            'buildings': [
-                {
-                    'id': building.id,
-                    'title': building.title,
-                    'title_info': building.title_info,
-                    'path': building.leading_img_path,
-                } for building in self.buildings
-            ],
-            'elements': [
-                {
-                    'id': element.id,
-                    'name': element.name,
-                    'description': element.description,
-                    'path': element.img_path
-
-                } for element in self.elements
-            ]
-        })
-        return result
-
 
 class ElementExample(db.Model, DictBase):
     id = db.Column(db.Integer, primary_key=True)
     img_path = db.Column(db.String, nullable=False)
+    img_path_srcset = db.Column(JSONText)
+    img_path_meta = db.Column(JSONText)
     building_id = db.Column(db.Integer, db.ForeignKey('building.id'), nullable=False)
     building = db.relationship('Building')
     element_id = db.Column(db.Integer, db.ForeignKey('element.id'), nullable=False)
@@ -359,44 +298,133 @@ class ElementPlace(db.Model, DictBase):
 
 
 class Element(db.Model, DictBase):
+    __table_args__ = (db.Index('ix_element_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=False)
     date = db.Column(db.Integer, nullable=False)
-    styles = db.relationship('Style', secondary=element_style, backref=db.backref('elements', lazy='dynamic'))
+    styles = db.relationship('Style', secondary=element_style, backref=db.backref('elements'))
     places = db.relationship('ElementPlace', backref=db.backref('element'))
     examples = db.relationship('ElementExample', backref=db.backref('element'))
     text = db.Column(db.Text, nullable=False)
     img_path = db.Column(db.String, nullable=False)
+    img_path_srcset = db.Column(JSONText)
+    img_path_meta = db.Column(JSONText)
 
     def __str__(self):
         return self.name
 
-    def to_dict(self):
-        result = dictonify(self.__dict__)
-        result.update({
-            'styles': [
-                {
-                    'id': style.id,
-                    'name': style.name
-                } for style in self.styles
-            ],
-            'places': [
-                {
-                    'id': place.id,
-                    'name': place.name
-                } for place in self.places
-            ],
-            'examples': [
-                {
-                    'id': example.id,
-                    'img_path': example.img_path,
-                    'building': {
-                        'id': example.building.id,
-                        'title': example.building.title,
-                        'title_info': example.building.title_info,
-                    }
-                } for example in self.examples
-            ]
-        })
-        return result
+
+class ImageJob(db.Model):
+    # making the resized copies of an uploaded image, see backend/jobs.py
+    __table_args__ = (db.Index('ix_image_job_status_run_after', 'status', 'run_after'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    target_table = db.Column(db.String, nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    target_column = db.Column(db.String, nullable=False)
+    filename = db.Column(db.String, nullable=False)
+    base_path = db.Column(db.String, nullable=False)
+    # pending, running, done or failed
+    status = db.Column(db.String, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __str__(self):
+        return '{}.{} #{}: {}'.format(self.target_table, self.target_column, self.target_id, self.status)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _touch(session, flush_context, instances):
+    # a row whose links change gets a new version too, even though none of its columns is updated:
+    # the one holding the changed collection and the rows added to or removed from it
+    now = datetime.utcnow()
+    for obj in list(session.dirty):
+        if not session.is_modified(obj):
+            continue
+        if hasattr(obj, 'updated_at'):
+            obj.updated_at = now
+
+        state = inspect(obj)
+        for relationship in state.mapper.relationships:
+            history = state.attrs[relationship.key].history
+            for other in list(history.added or ()) + list(history.deleted or ()):
+                if other is None or not hasattr(other, 'updated_at'):
+                    continue
+                if other not in session.new and other not in session.deleted:
+                    other.updated_at = now
+
+    # the rows a deleted one belonged to or was linked with, e.g. the building of a removed image
+    for obj in list(session.deleted):
+        state = inspect(obj)
+        for relationship in state.mapper.relationships:
+            if relationship.direction is MANYTOONE:
+                others = [getattr(obj, relationship.key)]
+            else:
+                history = state.attrs[relationship.key].history
+                others = list(history.unchanged or ()) + list(history.deleted or ())
+            for other in others:
+                if other is None or not hasattr(other, 'updated_at'):
+                    continue
+                if other not in session.new and other not in session.deleted:
+                    other.updated_at = now
+
+
+# set up backrefs right away so that loading plans can refer to them as class attributes
+configure_mappers()
+
+MetroRoute.serializer = Serializer(MetroRoute, relations={
+    'stations': attrgetter('id'),
+})
+
+MetroStation.serializer = Serializer(MetroStation, relations={
+    'routes': attrgetter('id'),
+})
+
+Building.serializer = Serializer(Building, relations={
+    'images': Serializer(BuildingImage, ['id', 'name', 'path', 'path_srcset', 'path_meta']),
+    'architects': Serializer(Architect, {'id': 'id', 'name': 'surname'}),
+    'styles': Serializer(Style, {'id': 'id', 'name': 'name', 'path': 'building_img_path',
+                                 'path_srcset': 'building_img_path_srcset', 'path_meta': 'building_img_path_meta'}),
+    'number_facts': Serializer(BuildingNumberFact, ['id', 'number', 'name']),
+    'text_facts': Serializer(BuildingTextFact, ['id', 'text']),
+})
+
+Architect.serializer = Serializer(Architect, relations={
+    'styles': Serializer(Style, ['id', 'name']),
+    'buildings': Serializer(Building, {'id': 'id', 'title': 'title', 'title_info': 'title_info',
+                                       'path': 'leading_img_path', 'path_srcset': 'leading_img_path_srcset',
+                                       'path_meta': 'leading_img_path_meta'}),
+    'facts': Serializer(ArchitectFact),
+})
+
+Style.serializer = Serializer(Style, fields=dict(
+    {prop.key: prop.key for prop in inspect(Style).column_attrs},
+    following_id=lambda style: style.following.id if style.following else None,
+), relations={
+    'architects': Serializer(Architect, {'id': 'id', 'surname': 'surname', 'patronymic': 'patronymic',
+                                         'name': 'name', 'path': 'img_path', 'path_srcset': 'img_path_srcset',
+                                         'path_meta': 'img_path_meta'}),
+    'buildings': Serializer(Building, {'id': 'id', 'title': 'title', 'title_info': 'title_info',
+                                      'path': 'leading_img_path', 'path_srcset': 'leading_img_path_srcset',
+                                      'path_meta': 'leading_img_path_meta'}),
+    'elements': Serializer(Element, {'id': 'id', 'name': 'name', 'description': 'description',
+                                     'path': 'img_path', 'path_srcset': 'img_path_srcset',
+                                     'path_meta': 'img_path_meta'}),
+})
+
+Element.serializer = Serializer(Element, relations={
+    'styles': Serializer(Style, ['id', 'name']),
+    'places': Serializer(ElementPlace, ['id', 'name']),
+    'examples': Serializer(ElementExample, ['id', 'img_path', 'img_path_srcset', 'img_path_meta'], relations={
+        'building': Serializer(Building, ['id', 'title', 'title_info']),
+    }),
+})
+
+for cls in DictBase.__subclasses__():
+    if cls.serializer is None:
+        cls.serializer = Serializer(cls)
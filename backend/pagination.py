@@ -0,0 +1,77 @@
+import json
+from bisect import bisect_right
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, size, types=None):
+    """The values of `cursor`, which must be `size` of them and, if given, of the python `types`."""
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(values, list) or len(values) != size:
+        abort(400)
+    for value, expected in zip(values, types or ()):
+        # JSON has no other integers than ints, but true and false are ints to python too
+        if not isinstance(value, expected) or isinstance(value, bool) and expected is not bool:
+            abort(400)
+    return values
+
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return object
+
+
+def get_limit():
+    limit = request.args.get('limit', type=int)
+    if limit is None or limit < 1:
+        abort(400)
+    return min(limit, current_app.config['API_MAX_LIMIT'])
+
+
+def paginate(query, columns, limit, cursor=None):
+    """Keyset pagination: rows strictly after `cursor` in `columns` order, no OFFSET involved.
+
+    `columns` must end with a unique column (the primary key) so that the order is total.
+    Returns the page and the cursor of the next page, which is None on the last one.
+    """
+    if cursor:
+        query = query.filter(tuple_(*columns) > tuple_(*decode_cursor(
+            cursor, len(columns), [_python_type(column) for column in columns])))
+
+    items = query.order_by(*columns).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in columns])
+
+    return items, next_cursor
+
+
+def paginate_keys(keys, limit, cursor=None):
+    """Same as paginate, over sort keys already computed and sorted in memory."""
+    start = 0
+    if cursor and keys:
+        try:
+            start = bisect_right(keys, tuple(decode_cursor(cursor, len(keys[0]))))
+        except TypeError:
+            abort(400)
+
+    page = keys[start:start + limit]
+
+    next_cursor = None
+    if start + limit < len(keys):
+        next_cursor = encode_cursor(list(page[-1]))
+
+    return page, next_cursor
@@ -0,0 +1,110 @@
+import random
+from array import array
+
+from sqlalchemy.orm import RelationshipProperty
+
+from backend.changes import LiveIndex, chunked
+from backend.database import db
+
+
+class IdSet:
+    """Ids kept in a compact array, with O(1) add, discard and uniform random choice."""
+
+    def __init__(self):
+        self._ids = array('l')
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, _id):
+        return _id in self._positions
+
+    def add(self, _id):
+        if _id not in self._positions:
+            self._positions[_id] = len(self._ids)
+            self._ids.append(_id)
+
+    def discard(self, _id):
+        position = self._positions.pop(_id, None)
+        if position is None:
+            return
+        last = self._ids.pop()
+        if position < len(self._ids):
+            self._ids[position] = last
+            self._positions[last] = position
+
+    def choice(self):
+        return self._ids[random.randrange(len(self._ids))]
+
+
+def _pair(cls, attr):
+    # (id column, value column) to read the filter values of the rows of cls from
+    prop = attr.property
+    if isinstance(prop, RelationshipProperty):
+        # many-to-many: read straight from the association table
+        return prop.synchronize_pairs[0][1], prop.secondary_synchronize_pairs[0][1]
+    return cls.id, attr
+
+
+class RandomPicker(LiveIndex):
+    """Picks a random id of `cls`, optionally restricted by the `filters`
+    (name -> foreign key column or many-to-many relationship), without touching the table."""
+
+    def __init__(self, cls, filters=None):
+        super(RandomPicker, self).__init__(cls)
+        self.cls = cls
+        self.filters = {name: _pair(cls, attr) for name, attr in (filters or {}).items()}
+
+    def rebuild(self):
+        self.ids = IdSet()
+        self.buckets = {name: {} for name in self.filters}
+        self._values = {}
+        self._load()
+
+    def update(self, changes):
+        ids = changes.get(self.cls.__table__.name, ())
+        for _id in ids:
+            self.ids.discard(_id)
+            for name, value in self._values.pop(_id, ()):
+                bucket = self.buckets[name][value]
+                bucket.discard(_id)
+                if not bucket:
+                    del self.buckets[name][value]
+
+        for chunk in chunked(ids):
+            self._load(chunk)
+
+    def _load(self, ids=None):
+        query = db.session.query(self.cls.id)
+        if ids is not None:
+            query = query.filter(self.cls.id.in_(ids))
+        for _id, in query:
+            self.ids.add(_id)
+
+        for name, (id_column, value_column) in self.filters.items():
+            query = db.session.query(id_column, value_column).filter(value_column.isnot(None))
+            if ids is not None:
+                query = query.filter(id_column.in_(ids))
+            for _id, value in query:
+                self.buckets[name].setdefault(value, IdSet()).add(_id)
+                self._values.setdefault(_id, []).append((name, value))
+
+    def pick(self, **filters):
+        """Returns a random id matching all filters (name=value), or None if there is none."""
+        if not filters:
+            candidates = self.ids
+        else:
+            sets = sorted((self.buckets[name].get(value, ()) for name, value in filters.items()), key=len)
+            candidates = sets[0]
+            if len(sets) > 1:
+                candidates = [_id for _id in candidates if all(_id in other for other in sets[1:])]
+
+        if not candidates:
+            return None
+        if isinstance(candidates, IdSet):
+            return candidates.choice()
+        return random.choice(candidates)
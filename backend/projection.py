@@ -0,0 +1,62 @@
+from functools import lru_cache
+
+from flask import abort, request
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+from backend.serializers import Serializer
+from backend.timing import timed
+
+
+def _names(arg):
+    return [name for name in arg.split(',') if name]
+
+
+class Projection:
+    """What to load and how to serialize it, given the ?fields= and ?embed= of a request.
+
+    ?fields= lists the fields to return (the id always comes along) and ?embed= the relationships
+    to embed, none if empty; all of them when a parameter is missing. Only the columns of those
+    fields are selected and only the loaders in `load` (output key -> loader option) of those
+    fields and relationships are applied, so whatever is left out is never read from the database.
+    """
+
+    def __init__(self, cls, load):
+        self.cls = cls
+        self.load = load
+        self.serializer = cls.serializer
+        self.full = (list(load.values()), self.serializer)
+        self._columns = {prop.key for prop in inspect(cls).column_attrs}
+        self._build = lru_cache(maxsize=256)(self._build)
+
+    def __call__(self, fields=None, embed=None):
+        """Returns the loader options and the serializer for the current request,
+        `fields` and `embed` being the defaults for missing parameters."""
+        fields = request.args.get('fields', fields)
+        embed = request.args.get('embed', embed)
+        if fields is None and embed is None:
+            options, serializer = self.full
+        else:
+            options, serializer = self._build(fields, embed)
+        return options, timed('serialize', serializer)
+
+    def _build(self, fields, embed):
+        serializer = self.serializer
+
+        fields = list(serializer.fields) if fields is None else ['id'] + [
+            name for name in _names(fields) if name != 'id'
+        ]
+        embed = list(serializer.relations) if embed is None else _names(embed)
+        if any(name not in serializer.fields for name in fields) or \
+                any(name not in serializer.relations for name in embed):
+            abort(400)
+
+        attrs = [serializer.fields[name] for name in fields]
+        # the version is what ETags are made of
+        columns = {'id', 'updated_at'} & self._columns
+        columns.update(attr for attr in attrs if isinstance(attr, str) and attr in self._columns)
+
+        options = [load_only(*columns)] + [self.load[name] for name in fields + embed if name in self.load]
+        serializer = Serializer(self.cls, {name: serializer.fields[name] for name in fields},
+                                {name: serializer.relations[name] for name in embed})
+        return options, serializer
@@ -0,0 +1,71 @@
+import os
+import os.path as op
+import shutil
+from functools import partial
+
+from backend import app, db
+# the new names have to reach the change logs, so that the API caches of running workers drop the old ones
+import backend.changes
+from backend.images import delete_derivatives
+from backend.jobs import enqueue
+from backend.storage import file_content_name, image_columns, is_content_name, store
+from backend.views import images_path
+
+
+# Moves the uploads stored under the names given by the old gen_filename to the content hash names
+# of backend/storage.py, and points the image columns at them. Copies of the images are made again
+# under the new names by the job runner. Can be run again, e.g. after being interrupted:
+#
+#   python -m backend.rekey_uploads
+
+def _link(source, path):
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def rekey_uploads(base_path):
+    get_path = partial(op.join, base_path)
+    names = {}
+    missing = set()
+    obsolete = []
+
+    for cls, column in image_columns():
+        attr = getattr(cls, column)
+        for obj in cls.query.filter(attr.isnot(None)):
+            old = getattr(obj, column)
+            if is_content_name(old) or old in missing:
+                continue
+
+            if old not in names:
+                if not op.exists(get_path(old)):
+                    missing.add(old)
+                    continue
+                # the old file stays until the new names are committed
+                names[old] = file_content_name(get_path(old))
+                store(get_path(names[old]), lambda tmp, old=old: _link(get_path(old), tmp))
+
+            obsolete.append(getattr(obj, column + '_srcset'))
+            setattr(obj, column, names[old])
+            setattr(obj, column + '_srcset', None)
+            setattr(obj, column + '_meta', None)
+            enqueue(obj, column, op.abspath(base_path))
+
+    db.session.commit()
+
+    for old in names:
+        os.remove(get_path(old))
+    for srcset in obsolete:
+        delete_derivatives(srcset, get_path)
+
+    return names, missing
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        names, missing = rekey_uploads(images_path)
+    for old, new in sorted(names.items()):
+        print('{} -> {}'.format(old, new))
+    for old in sorted(missing):
+        print('{}: missing, left as it is'.format(old))
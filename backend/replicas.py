@@ -0,0 +1,120 @@
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+# The GET requests of the views wrapped in on_replica() read from the databases in SQLALCHEMY_REPLICAS,
+# one replica per request, picked by REPLICA_SELECTION. Everything else stays on the primary: other views
+# (the admin), sessions that have flushed changes, and all requests for REPLICA_MAX_LAG seconds after
+# a commit, so that what the in-process indexes and the response cache learn from the change logs
+# is not read back from a replica that hasn't caught up yet.
+#
+# A replica is tried before its first use and whenever it failed REPLICA_RETRY_INTERVAL seconds ago;
+# while none answers, the primary is read instead.
+
+
+class Replica:
+
+    def __init__(self, uri, engine, retry_interval):
+        self.uri = uri
+        self.engine = engine
+        self.retry_interval = retry_interval
+        self.in_use = 0
+        self.healthy = False
+        self.down_until = 0
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.in_use += 1
+
+    def _checkin(self, dbapi_connection, connection_record):
+        self.in_use -= 1
+
+    def _handle_error(self, context):
+        # the requests already reading from it fail, the following ones go elsewhere
+        if context.is_disconnect or context.connection is None:
+            self.fail()
+
+    def fail(self):
+        self.healthy = False
+        self.down_until = time.time() + self.retry_interval
+
+    def check(self):
+        try:
+            self.engine.connect().close()
+        except Exception:
+            self.fail()
+        else:
+            self.healthy = True
+        return self.healthy
+
+
+class Replicas:
+
+    def __init__(self):
+        self._replicas = None
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def _load(self, db):
+        with self._lock:
+            if self._replicas is None:
+                app = current_app._get_current_object()
+                self._replicas = [
+                    Replica(uri, db.create_replica_engine(app, uri), app.config['REPLICA_RETRY_INTERVAL'])
+                    for uri in app.config['SQLALCHEMY_REPLICAS']
+                ]
+        return self._replicas
+
+    def pick(self, db):
+        """The engine of a replica able to answer, None if there's none."""
+        replicas = self._replicas if self._replicas is not None else self._load(db)
+        if not replicas:
+            return None
+
+        now = time.time()
+        start = next(self._turn) % len(replicas)
+        candidates = [replica for replica in replicas[start:] + replicas[:start] if replica.down_until <= now]
+        if current_app.config['REPLICA_SELECTION'] == 'least_connections':
+            # the sort is stable, equally busy replicas are taken in turns
+            candidates.sort(key=lambda replica: replica.in_use)
+
+        for replica in candidates:
+            if replica.healthy or replica.check():
+                return replica.engine
+        return None
+
+
+replicas = Replicas()
+
+
+def read_engine(db):
+    """The engine the reads of the current request should go to, None for the primary."""
+    # backend.changes uses the session, which uses this module
+    from backend.changes import last_commit
+
+    if not has_request_context() or not g.get('read_replica'):
+        return None
+    if time.time() - last_commit() < current_app.config['REPLICA_MAX_LAG']:
+        return None
+
+    if 'replica_engine' not in g:
+        g.replica_engine = replicas.pick(db)
+    return g.replica_engine
+
+
+def on_replica(view):
+    """Lets the GET requests of `view` read from a replica."""
+
+    @wraps(view)
+    def _view(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            g.read_replica = True
+        return view(*args, **kwargs)
+
+    return _view
@@ -1,95 +1,479 @@
-import random, os, os.path as op
+import os, os.path as op
+from collections import OrderedDict
+from math import isfinite
 
-from flask import jsonify, url_for, request
+from flask import abort, jsonify, url_for, request, Response
 
 from flask_admin import helpers
+from sqlalchemy import func, literal
+from sqlalchemy.orm import joinedload, subqueryload
 
 from backend import app, admin, db, security
 from backend.models import DictBase, Building, Architect, Region, District, MetroRoute, MetroStation, Style, Element,\
-    User, Role
+    ElementExample, ImageJob, User, Role
+from backend.cache import ResponseCache, cached
+from backend.changes import chunked
+from backend.clusters import MAX_ZOOM, ClusterIndex
+from backend.facets import VALUES, YEARS, FacetIndex
+from backend.files import send_image
+from backend.geo import GeoIndex
+from backend.metrics import metrics
+from backend.metro import MetroGraph
+from backend.pagination import decode_cursor, encode_cursor, get_limit, paginate, paginate_keys
+from backend.picker import RandomPicker
+from backend.projection import Projection
+from backend.replicas import on_replica
+from backend.search import SearchIndex
+from backend.storage import is_content_name
 from backend.views import SuperuserModelView, UserModelView, BuildingView, ArchitectView, ElementView, StyleView, \
-    MetroStationView, DistrictView, RegionView, MetroRouteView, UserView
+    MetroStationView, DistrictView, RegionView, MetroRouteView, UserView, ImageJobView, images_path
 
 # mapping between endpoints and classes
+# 'load' is the loading plan: every relationship walked by to_dict is fetched in one batch per query,
+# keyed by the output field or relationship needing it so that ?fields= and ?embed= can leave it out
+# 'random' lists the filters accepted by /random
+# 'search_columns' are matched by the search parameter, only the 'search' column if not given
 mapping = {
     'regions': {
         'class': Region,
-        'search': 'name'
+        'search': 'name',
+        'load': {},
+        'random': {},
     },
     'districts': {
         'class': District,
-        'search': 'name'
+        'search': 'name',
+        'load': {},
+        'random': {
+            'region': District.region_id,
+        },
     },
     'metro_routes': {
         'class': MetroRoute,
-        'search': 'name'
+        'search': 'name',
+        'load': {
+            'stations': subqueryload(MetroRoute.stations),
+        },
+        'random': {},
     },
     'metro_stations': {
         'class': MetroStation,
-        'search': 'name'
+        'search': 'name',
+        'load': {
+            'routes': subqueryload(MetroStation.routes),
+        },
+        'random': {
+            'district': MetroStation.district_id,
+            'route': MetroStation.routes,
+        },
     },
     'buildings': {
         'class': Building,
-        'search': 'title'
+        'search': 'title',
+        'load': {
+            'images': subqueryload(Building.images),
+            'architects': subqueryload(Building.architects),
+            'styles': subqueryload(Building.styles),
+            'number_facts': subqueryload(Building.number_facts),
+            'text_facts': subqueryload(Building.text_facts),
+        },
+        'random': {
+            'style': Building.styles,
+            'architect': Building.architects,
+            'district': Building.district_id,
+            'station': Building.station_id,
+        },
     },
     'architects': {
         'class': Architect,
-        'search': 'name'
+        'search': 'name',
+        'search_columns': [Architect.name, Architect.surname, Architect.patronymic],
+        'load': {
+            'styles': subqueryload(Architect.styles),
+            'buildings': subqueryload(Architect.buildings),
+            'facts': subqueryload(Architect.facts),
+        },
+        'random': {
+            'style': Architect.styles,
+        },
     },
     'styles': {
         'class': Style,
-        'search': 'name'
+        'search': 'name',
+        'load': {
+            'following_id': joinedload(Style.following).load_only('id', 'updated_at'),
+            'architects': subqueryload(Style.architects),
+            'buildings': subqueryload(Style.buildings),
+            'elements': subqueryload(Style.elements),
+        },
+        'random': {},
     },
     'elements': {
         'class': Element,
-        'search': 'name'
+        'search': 'name',
+        'load': {
+            'styles': subqueryload(Element.styles),
+            'places': subqueryload(Element.places),
+            'examples': subqueryload(Element.examples).joinedload(ElementExample.building),
+        },
+        'random': {
+            'style': Element.styles,
+        },
     },
 }
 
 
-def get_all(_cls, _search):
+def get_many(_cls, options, ids):
+    # rows in the order of ids, skipping the ones that do not exist
+    items = {}
+    for chunk in chunked(ids):
+        items.update((item.id, item) for item in _cls.query.options(*options).filter(_cls.id.in_(chunk)))
+    return [items[_id] for _id in ids if _id in items]
+
+
+def get_batch(_cls, options, serialize, ids):
+    try:
+        ids = list(OrderedDict.fromkeys(int(_id) for _id in ids))
+    except (TypeError, ValueError):
+        abort(400)
+    if not ids or len(ids) > app.config['API_MAX_LIMIT']:
+        abort(400)
+
+    items = get_many(_cls, options, ids)
+    found = {item.id for item in items}
+
+    return jsonify({
+        'items': [serialize(item) for item in items],
+        'missing': [_id for _id in ids if _id not in found],
+    })
+
+
+def get_all(_cls, _search, _projection, _index):
     def _get_all():
+        options, serialize = _projection()
+
+        if 'ids' in request.args:
+            return get_batch(_cls, options, serialize, [_id for _id in request.args['ids'].split(',') if _id])
 
         if _search in request.args:
             search = request.args[_search]
         else:
             search = None
 
+        order = request.args.get('order', 'relevance' if search else 'id')
+        if order not in ('id', _search) and not (search and order == 'relevance'):
+            abort(400)
+
+        # without ?limit= the whole collection is returned as a plain array, as old clients expect
+        paginated = 'limit' in request.args
+        next_cursor = None
+
         if search:
-            items = _cls.query.filter(getattr(_cls, _search).like('%'+search+'%')).all()
+            keys = _index.refresh().search(search, order)
+            if paginated:
+                keys, next_cursor = paginate_keys(keys, get_limit(), request.args.get('cursor'))
+            items = get_many(_cls, options, [key[-1] for key in keys])
+        elif paginated:
+            columns = [_cls.id] if order == 'id' else [getattr(_cls, _search), _cls.id]
+            query = _cls.query.options(*options)
+            items, next_cursor = paginate(query, columns, get_limit(), request.args.get('cursor'))
         else:
-            items = _cls.query.all()
+            items = _cls.query.options(*options).all()
 
-        return jsonify([item.to_dict() for item in items])
+        if not paginated:
+            return jsonify([serialize(item) for item in items])
+
+        return jsonify({
+            'items': [serialize(item) for item in items],
+            'next': next_cursor,
+        })
 
     return _get_all
 
 
-def get_one(_cls):
+def post_batch(_cls, _projection):
+
+    def _post_batch():
+        options, serialize = _projection()
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('ids'), list):
+            abort(400)
+
+        return get_batch(_cls, options, serialize, data['ids'])
+
+    return _post_batch
+
+
+def get_one(_cls, _projection):
 
     def _get_one(_id):
-        item = _cls.query.get_or_404(_id)
-        return jsonify(item.to_dict())
+        options, serialize = _projection()
+        item = _cls.query.options(*options).get_or_404(_id)
+        return jsonify(serialize(item))
 
     return _get_one
 
 
-def get_random(_cls):
+def get_random(_cls, _projection, _picker):
 
     def _get_random():
-        count = _cls.query.count()
-        rnd = random.randrange(0, count)
-        item = _cls.query[rnd]
-        return jsonify(item.to_dict())
+        options, serialize = _projection()
+
+        filters = {}
+        for name in _picker.filters:
+            if name in request.args:
+                filters[name] = request.args.get(name, type=int)
+                if filters[name] is None:
+                    abort(400)
+
+        _id = _picker.refresh().pick(**filters)
+        if _id is None:
+            abort(404)
+
+        item = _cls.query.options(*options).get_or_404(_id)
+        return jsonify(serialize(item))
 
     return _get_random
 
 
+# fields for drawing a building on the map
+SLIM = 'title,latitude,longitude,leading_img_path,leading_img_path_srcset,leading_img_path_meta'
+
+
+def get_bbox():
+    # bbox=min_lon,min_lat,max_lon,max_lat
+    try:
+        bbox = [float(value) for value in request.args['bbox'].split(',')]
+    except (KeyError, ValueError):
+        abort(400)
+    if len(bbox) != 4 or not all(map(isfinite, bbox)):
+        abort(400)
+    return bbox
+
+
+def get_within(_cls, _projection, _index):
+
+    def _get_within():
+        min_lon, min_lat, max_lon, max_lat = get_bbox()
+
+        options, serialize = _projection(SLIM, '')
+        limit = get_limit() if 'limit' in request.args else app.config['API_MAX_LIMIT']
+
+        ids = _index.refresh().within(min_lat, min_lon, max_lat, max_lon)
+        items = get_many(_cls, options, ids[:limit])
+
+        return jsonify({
+            'items': [serialize(item) for item in items],
+            'count': len(ids),
+        })
+
+    return _get_within
+
+
+def get_nearest(_cls, _projection, _index):
+
+    def _get_nearest():
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        k = request.args.get('k', 10, type=int)
+        if lat is None or lon is None or not isfinite(lat) or not isfinite(lon):
+            abort(400)
+        if k is None or not 0 < k <= app.config['API_MAX_LIMIT']:
+            abort(400)
+
+        options, serialize = _projection(SLIM, '')
+
+        nearest = _index.refresh().nearest(lat, lon, k)
+        items = {item.id: item for item in get_many(_cls, options, [_id for _, _id in nearest])}
+
+        return jsonify([
+            dict(serialize(items[_id]), distance=round(distance))
+            for distance, _id in nearest if _id in items
+        ])
+
+    return _get_nearest
+
+
+def get_faceted(_projection, _index):
+
+    def _get_faceted():
+        # ?style=1,2&district=3&year_from=1900&year_to=1930, values of a facet are alternatives
+        filters = {}
+        try:
+            for name in VALUES:
+                if name in request.args:
+                    filters[name] = {int(value) for value in request.args[name].split(',') if value}
+            for name in YEARS:
+                if name in request.args:
+                    filters[name] = int(request.args[name])
+        except ValueError:
+            abort(400)
+
+        after = None
+        if request.args.get('cursor'):
+            after, = decode_cursor(request.args['cursor'], 1)
+            if not isinstance(after, int):
+                abort(400)
+
+        options, serialize = _projection(SLIM, '')
+        limit = get_limit() if 'limit' in request.args else app.config['API_MAX_LIMIT']
+
+        ids, count, facets = _index.refresh().search(filters, limit + 1, after)
+        next_cursor = encode_cursor(ids[limit - 1:limit]) if len(ids) > limit else None
+        items = get_many(Building, options, ids[:limit])
+
+        return jsonify({
+            'items': [serialize(item) for item in items],
+            'count': count,
+            'next': next_cursor,
+            'facets': {facet: [{'value': value, 'count': n} for value, n in counts]
+                       for facet, counts in facets.items()},
+        })
+
+    return _get_faceted
+
+
+def style_chain(start=None):
+    """Ids of the styles in timeline order, following `following` from `start` or from every first style."""
+    first = Style.id == start if start is not None else Style.previous_id.is_(None)
+    chain = db.session.query(Style.id, Style.id.label('first'), literal(0).label('position')) \
+        .filter(first).cte('chain', recursive=True)
+    # a chain can't be longer than the table, even if it was edited into a loop
+    longest = db.session.query(func.count(Style.id)).as_scalar()
+    chain = chain.union_all(
+        db.session.query(Style.id, chain.c.first, chain.c.position + 1)
+        .filter(Style.previous_id == chain.c.id, chain.c.position < longest)
+    )
+    firsts = db.session.query(Style.id, Style.date).subquery()
+    ids = db.session.query(chain.c.id) \
+        .join(firsts, firsts.c.id == chain.c.first) \
+        .order_by(firsts.c.date, chain.c.first, chain.c.position, chain.c.id)
+    return list(OrderedDict.fromkeys(_id for _id, in ids))
+
+
+def get_style_timeline(_projection):
+
+    def _get_style_timeline():
+        # ?from=id starts at that style instead
+        start = None
+        if 'from' in request.args:
+            start = request.args.get('from', type=int)
+            if start is None:
+                abort(400)
+
+        options, serialize = _projection()
+        ids = style_chain(start)
+        if start is not None and not ids:
+            abort(404)
+
+        return jsonify([serialize(item) for item in get_many(Style, options, ids)])
+
+    return _get_style_timeline
+
+
+def get_clusters(_index):
+
+    def _get_clusters():
+        zoom = request.args.get('zoom', type=int)
+        min_lon, min_lat, max_lon, max_lat = get_bbox()
+        if zoom is None or not 0 <= zoom <= MAX_ZOOM:
+            abort(400)
+
+        return jsonify(_index.refresh().within(zoom, min_lat, min_lon, max_lat, max_lon))
+
+    return _get_clusters
+
+
+def get_cluster_tile(_index):
+
+    def _get_cluster_tile(zoom, x, y):
+        if zoom > MAX_ZOOM or x >= 1 << zoom or y >= 1 << zoom:
+            abort(404)
+        return jsonify(_index.refresh().tile(zoom, x, y))
+
+    return _get_cluster_tile
+
+
+def get_metro_graph(_graph):
+
+    def _get_metro_graph():
+        return jsonify(_graph.refresh().payload)
+
+    return _get_metro_graph
+
+
+def get_image(_directory):
+
+    def _get_image(folder, filename):
+        # only uploads are named after their content, the static images keep their names when changed
+        immutable = folder == 'uploads' and is_content_name(filename)
+        accel = app.config['IMAGES_ACCEL_REDIRECT']
+        return send_image(op.join(_directory, folder), filename, accel and accel + folder + '/', immutable)
+
+    return _get_image
+
+
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def cache_metrics(_metrics):
+    stats = response_cache.stats()
+    for name in 'hits', 'misses', 'evictions', 'invalidations':
+        _metrics.set('response_cache_{}_total'.format(name), stats[name])
+    _metrics.set('response_cache_entries', stats['entries'])
+    _metrics.set('response_cache_bytes', stats['bytes'])
+
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_MAX_ENTRIES'], app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+metrics.collector(cache_metrics)
+
+app.add_url_rule('/api/cache', 'get_cache_stats', get_cache_stats)
+app.add_url_rule('/metrics', 'get_metrics', get_metrics)
+app.add_url_rule('/images/<any(static, uploads):folder>/<path:filename>', 'get_image',
+                 get_image(op.dirname(op.abspath(images_path))))
+
 for endpoint, val in mapping.items():
-    app.add_url_rule('/api/' + endpoint, 'get_' + endpoint + '_all', get_all(val['class'], val['search']))
-    app.add_url_rule('/api/' + endpoint + '/<int:_id>', 'get_' + endpoint + '_one', get_one(val['class'],))
-    app.add_url_rule('/api/' + endpoint + '/random', 'get_' + endpoint + '_random', get_random(val['class'],))
+    projection = Projection(val['class'], val['load'])
+    index = SearchIndex(val['class'], val.get('search_columns', [getattr(val['class'], val['search'])]))
+    app.add_url_rule('/api/' + endpoint, 'get_' + endpoint + '_all', on_replica(
+        cached(response_cache, [val['class']])(get_all(val['class'], val['search'], projection, index))))
+    app.add_url_rule('/api/' + endpoint + '/batch', 'post_' + endpoint + '_batch',
+                     post_batch(val['class'], projection), methods=['POST'])
+    app.add_url_rule('/api/' + endpoint + '/<int:_id>', 'get_' + endpoint + '_one',
+                     on_replica(cached(response_cache)(get_one(val['class'], projection))))
+    app.add_url_rule('/api/' + endpoint + '/random', 'get_' + endpoint + '_random',
+                     on_replica(get_random(val['class'], projection, RandomPicker(val['class'], val['random']))))
+
+app.add_url_rule('/api/styles/timeline', 'get_styles_timeline', on_replica(
+    cached(response_cache, [Style])(get_style_timeline(Projection(Style, mapping['styles']['load'])))))
+
+geo_index = GeoIndex(Building, Building.latitude, Building.longitude, app.config['GEO_CELL'])
+cluster_index = ClusterIndex(Building, Building.latitude, Building.longitude,
+                             app.config['CLUSTER_MAX_ZOOM'], app.config['CLUSTER_RADIUS'])
+buildings_projection = Projection(Building, mapping['buildings']['load'])
+
+app.add_url_rule('/api/buildings/within', 'get_buildings_within', on_replica(
+    cached(response_cache, [Building])(get_within(Building, buildings_projection, geo_index))))
+app.add_url_rule('/api/buildings/nearest', 'get_buildings_nearest', on_replica(
+    cached(response_cache, [Building])(get_nearest(Building, buildings_projection, geo_index))))
+app.add_url_rule('/api/buildings/facets', 'get_buildings_facets', on_replica(
+    cached(response_cache, [Building, District])(get_faceted(buildings_projection, FacetIndex()))))
+app.add_url_rule('/api/buildings/clusters', 'get_buildings_clusters',
+                 on_replica(cached(response_cache, [Building])(get_clusters(cluster_index))))
+app.add_url_rule('/api/buildings/clusters/<int:zoom>/<int:x>/<int:y>', 'get_buildings_cluster_tile',
+                 on_replica(cached(response_cache, [Building])(get_cluster_tile(cluster_index))))
+
+metro_graph = MetroGraph()
 
+app.add_url_rule('/api/metro/graph', 'get_metro_graph', on_replica(
+    cached(response_cache, [MetroRoute, MetroStation])(get_metro_graph(metro_graph))))
 
 admin.add_view(SuperuserModelView(Role, db.session))
 admin.add_view(UserView(User, db.session))
@@ -102,6 +486,7 @@ admin.add_view(MetroRouteView(MetroRoute, db.session))
 admin.add_view(MetroStationView(MetroStation, db.session))
 admin.add_view(DistrictView(District, db.session))
 admin.add_view(RegionView(Region, db.session))
+admin.add_view(ImageJobView(ImageJob, db.session, name='Image Jobs'))
 
 # define a context processor for merging flask-admin's template context into the
 # flask-security views.
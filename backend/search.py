@@ -0,0 +1,102 @@
+from backend.changes import LiveIndex, chunked
+from backend.database import db
+
+
+def normalize(text):
+    # case-insensitive for Cyrillic too, and 'ё' is commonly typed as 'е'
+    return text.casefold().replace('ё', 'е')
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _tier(term, text):
+    if text == term:
+        return 0
+    if text.startswith(term):
+        return 1
+    if (' ' + text).find(' ' + term) != -1:
+        return 2
+    return 3
+
+
+class SearchIndex(LiveIndex):
+    """In-process trigram index answering case-insensitive substring searches over `columns` of `cls`.
+
+    Candidates come from intersecting the posting lists of the trigrams of the term and are then
+    checked for the actual substring, so results are the same as a case-insensitive LIKE '%term%'.
+    """
+
+    def __init__(self, cls, columns):
+        super(SearchIndex, self).__init__(cls)
+        self.cls = cls
+        self.columns = columns
+
+    def rebuild(self):
+        self.texts = {}
+        self.postings = {}
+        self._load()
+
+    def update(self, changes):
+        ids = changes.get(self.cls.__table__.name, ())
+        for _id in ids:
+            self._remove(_id)
+        for chunk in chunked(ids):
+            self._load(chunk)
+
+    def _load(self, ids=None):
+        query = db.session.query(self.cls.id, *self.columns)
+        if ids is not None:
+            query = query.filter(self.cls.id.in_(ids))
+
+        for row in query:
+            _id = row[0]
+            texts = tuple(normalize(value or '') for value in row[1:])
+            self.texts[_id] = texts
+            for gram in set().union(*map(trigrams, texts)):
+                self.postings.setdefault(gram, set()).add(_id)
+
+    def _remove(self, _id):
+        texts = self.texts.pop(_id, None)
+        if texts is None:
+            return
+        for gram in set().union(*map(trigrams, texts)):
+            posting = self.postings[gram]
+            posting.discard(_id)
+            if not posting:
+                del self.postings[gram]
+
+    def search(self, term, order='relevance'):
+        """Returns the sort keys of the matching rows, sorted; the last item of every key is the id.
+
+        By relevance an exact match comes first, then a match at the start of the text,
+        then at the start of a word, then anywhere; shorter texts first within each tier.
+        Otherwise rows are sorted by 'id' or by the first indexed column.
+        """
+        term = normalize(term)
+
+        grams = trigrams(term)
+        if grams:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            # too short for trigrams, check every text in memory
+            candidates = self.texts
+
+        keys = []
+        for _id in candidates:
+            texts = self.texts[_id]
+            matched = [text for text in texts if term in text]
+            if not matched:
+                continue
+
+            if order == 'relevance':
+                keys.append(min((_tier(term, text), len(text), _id) for text in matched))
+            elif order == 'id':
+                keys.append((_id,))
+            else:
+                keys.append((texts[0], _id))
+
+        keys.sort()
+        return keys
@@ -0,0 +1,313 @@
+"""Fills the database with generated data at any scale, for load tests.
+
+    python -m backend.seed [--db URI] [--buildings N] [--architects N] ... [--batch N] [--seed N]
+
+Unlike create_db, rows never go through the ORM: they are generated table by table with their ids
+worked out up front, and loaded in batches with COPY on PostgreSQL and executemany() elsewhere (SQLite).
+The schema is dropped and created again first.
+"""
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import datetime
+
+from backend import app, db
+from backend.changes import reset_logs
+from backend.models import Building, BuildingImage, BuildingNumberFact, BuildingTextFact, Architect, ArchitectFact, \
+    Style, Element, ElementPlace, ElementExample, MetroRoute, MetroStation, District, Region, building_architect, \
+    building_style, architect_style, element_style, station_route
+
+# (min, max) of the related rows per row
+IMAGES = (1, 5)
+NUMBER_FACTS = (0, 3)
+TEXT_FACTS = (1, 2)
+ARCHITECT_FACTS = (1, 4)
+BUILDING_ARCHITECTS = (1, 3)
+BUILDING_STYLES = (1, 2)
+ARCHITECT_STYLES = (1, 3)
+ELEMENT_STYLES = (1, 3)
+ELEMENT_PLACES = (2, 6)
+ELEMENT_EXAMPLES = (1, 4)
+
+# buildings are spread around the centre of Moscow
+CENTRE = (55.751244, 37.618423)
+SPREAD = 0.08
+
+LETTERS = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+
+
+class Text:
+    """Random text made of a fixed vocabulary, much cheaper than picking every letter."""
+
+    def __init__(self, words=5000):
+        self.words = [''.join(random.choice(LETTERS) for _ in range(random.randint(3, 10))) for _ in range(words)]
+        self.paragraphs = ['<p>{}</p>'.format(self(50, 150)) for _ in range(100)]
+
+    def __call__(self, low, high):
+        return ' '.join(random.sample(self.words, random.randint(low, high)))
+
+    def html(self):
+        return ''.join(random.sample(self.paragraphs, random.randint(2, 4)))
+
+
+def _some(count, limits):
+    # distinct ids from 1 to count
+    return random.sample(range(1, count + 1), min(count, random.randint(*limits)))
+
+
+def generate(sizes, text, now):
+    """Yields (table, rows) in an order satisfying foreign keys, rows being an iterator of dicts."""
+    n = sizes
+
+    def regions():
+        for i in range(1, n.regions + 1):
+            yield dict(id=i, name='Округ #{}'.format(i), abbr='ABBR', description=text(3, 8), updated_at=now)
+
+    def districts():
+        for i in range(1, n.districts + 1):
+            yield dict(id=i, name='Район #{}'.format(i), region_id=random.randint(1, n.regions),
+                       description=text(3, 8), updated_at=now)
+
+    def routes():
+        for i in range(1, n.routes + 1):
+            yield dict(id=i, name='Ветка #{}'.format(i), updated_at=now,
+                       color='rgb({},{},{})'.format(*(random.randint(0, 255) for _ in range(3))))
+
+    def stations():
+        for i in range(1, n.stations + 1):
+            yield dict(id=i, name='Станция #{}'.format(i), district_id=random.randint(1, n.districts),
+                       description=text(3, 8), updated_at=now)
+
+    def station_routes():
+        for i in range(1, n.stations + 1):
+            for route in {(i - 1) % n.routes + 1, i % n.routes + 1}:
+                yield dict(station_id=i, route_id=route)
+
+    def buildings():
+        for i in range(1, n.buildings + 1):
+            start = random.randint(1700, 2000)
+            yield dict(id=i, title='{} #{}'.format(text(1, 3).capitalize(), i), title_info=text(2, 6),
+                       address='{} ул., {}'.format(text(1, 1).capitalize(), random.randint(1, 200)),
+                       year_build_start=start, year_build_end=start + random.randint(0, 15),
+                       latitude=random.gauss(CENTRE[0], SPREAD), longitude=random.gauss(CENTRE[1], SPREAD * 2),
+                       leading_img_path='visotka.jpg', text=text.html(),
+                       station_id=random.randint(1, n.stations), district_id=random.randint(1, n.districts),
+                       updated_at=now)
+
+    def images():
+        _id = 0
+        for i in range(1, n.buildings + 1):
+            for j in range(random.randint(*IMAGES)):
+                _id += 1
+                yield dict(id=_id, name='image #{}:{}'.format(j + 1, i), building_id=i, updated_at=now,
+                           path=random.choice(['shema.jpg', 'visota.jpg']))
+
+    def number_facts():
+        _id = 0
+        for i in range(1, n.buildings + 1):
+            for j in range(random.randint(*NUMBER_FACTS)):
+                _id += 1
+                yield dict(id=_id, number=random.randint(1, 1000), name=text(1, 3), building_id=i, updated_at=now)
+
+    def text_facts():
+        _id = 0
+        for i in range(1, n.buildings + 1):
+            for j in range(random.randint(*TEXT_FACTS)):
+                _id += 1
+                yield dict(id=_id, text=text(10, 40), building_id=i, updated_at=now)
+
+    def architects():
+        for i in range(1, n.architects + 1):
+            born = random.choice([None, random.randint(1700, 1990)])
+            died = born and random.choice([None, born + random.randint(30, 90)])
+            yield dict(id=i, name=text(1, 1).capitalize(), surname=text(1, 1).capitalize(),
+                       patronymic=text(1, 1).capitalize(), born=born, died=died, alive=born is not None and not died,
+                       place_of_birth=text(1, 3), quote=text(5, 15), text=text.html(),
+                       img_path='shusev.jpg', square_img='arch-square.png', portrait_img='arch-portrait.png',
+                       landscape_img='arch-landscape.png', updated_at=now)
+
+    def architect_facts():
+        _id = 0
+        for i in range(1, n.architects + 1):
+            for j in range(random.randint(*ARCHITECT_FACTS)):
+                _id += 1
+                yield dict(id=_id, name=text(1, 3), text=text(5, 20), architect_id=i, updated_at=now)
+
+    def building_architects():
+        for i in range(1, n.buildings + 1):
+            for architect in _some(n.architects, BUILDING_ARCHITECTS):
+                yield dict(building_id=i, architect_id=architect)
+
+    def styles():
+        for i in range(1, n.styles + 1):
+            yield dict(id=i, name='Стиль #{}'.format(i), previous_id=i - 1 if i > 1 else None,
+                       date=1600 + i * 400 // n.styles, philosophy=text(3, 10), ideology=text(3, 10),
+                       text=text.html(), fact=text(10, 30), building_img_path='klass-build.svg',
+                       door_handle_img_path='klass-door.svg', column_img_path='klass-col.svg',
+                       description=text(5, 12), updated_at=now)
+
+    def building_styles():
+        for i in range(1, n.buildings + 1):
+            for style in _some(n.styles, BUILDING_STYLES):
+                yield dict(building_id=i, style_id=style)
+
+    def architect_styles():
+        for i in range(1, n.architects + 1):
+            for style in _some(n.styles, ARCHITECT_STYLES):
+                yield dict(architect_id=i, style_id=style)
+
+    def elements():
+        for i in range(1, n.elements + 1):
+            yield dict(id=i, name='Element #{}'.format(i), description=text(5, 12),
+                       date=random.randint(1600, 2000), text=text.html(), img_path='kartush.svg', updated_at=now)
+
+    def element_styles():
+        for i in range(1, n.elements + 1):
+            for style in _some(n.styles, ELEMENT_STYLES):
+                yield dict(element_id=i, style_id=style)
+
+    def element_places():
+        _id = 0
+        for i in range(1, n.elements + 1):
+            for j in range(random.randint(*ELEMENT_PLACES)):
+                _id += 1
+                yield dict(id=_id, name='Element Place #{}:{}'.format(j + 1, i), element_id=i, updated_at=now)
+
+    def element_examples():
+        _id = 0
+        for i in range(1, n.elements + 1):
+            for j in range(random.randint(*ELEMENT_EXAMPLES)):
+                _id += 1
+                yield dict(id=_id, img_path='usadba.jpg', building_id=random.randint(1, n.buildings), element_id=i,
+                           updated_at=now)
+
+    return [
+        (Region.__table__, regions()),
+        (District.__table__, districts()),
+        (MetroRoute.__table__, routes()),
+        (MetroStation.__table__, stations()),
+        (station_route, station_routes()),
+        (Building.__table__, buildings()),
+        (BuildingImage.__table__, images()),
+        (BuildingNumberFact.__table__, number_facts()),
+        (BuildingTextFact.__table__, text_facts()),
+        (Architect.__table__, architects()),
+        (ArchitectFact.__table__, architect_facts()),
+        (building_architect, building_architects()),
+        (Style.__table__, styles()),
+        (building_style, building_styles()),
+        (architect_style, architect_styles()),
+        (Element.__table__, elements()),
+        (element_style, element_styles()),
+        (ElementPlace.__table__, element_places()),
+        (ElementExample.__table__, element_examples()),
+    ]
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy(connection, table, batch):
+    columns = list(batch[0])
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in batch:
+        writer.writerow([row[column] for column in columns])
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ', '.join('"{}"'.format(column) for column in columns)), buf)
+
+
+def _insert(connection, table, batch):
+    connection.execute(table.insert(), batch)
+
+
+def load(tables, batch_size, report=print):
+    """Loads the (table, rows) of generate() batch by batch, a transaction each. Returns the rows per table."""
+    engine = db.engine
+    postgresql = engine.dialect.name == 'postgresql'
+    write = _copy if postgresql else _insert
+    counts = {}
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            # every batch is a transaction of its own, there is no need to wait for each to hit the disk
+            connection.execute('PRAGMA synchronous = OFF')
+
+        for table, rows in tables:
+            count = 0
+            started = time.time()
+            for batch in _batches(rows, batch_size):
+                with connection.begin():
+                    write(connection, table, batch)
+                count += len(batch)
+            elapsed = time.time() - started
+            counts[table.name] = count
+            report('{:<22} {:>10} rows {:>8.1f} s {:>10.0f} rows/s'.format(
+                table.name, count, elapsed, count / elapsed if elapsed else 0))
+
+        if postgresql:
+            # the ids were given explicitly, the sequences have to catch up
+            for table, _ in tables:
+                if 'id' in table.c:
+                    connection.execute("SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                                       "coalesce(max(id), 1)) FROM \"{0}\"".format(table.name))
+
+    return counts
+
+
+def seed(sizes, batch_size=10000, report=print):
+    """Replaces everything in the database with generated rows, `sizes` having the row counts of main()."""
+    db.reflect()
+    db.drop_all()
+    db.create_all()
+
+    started = time.time()
+    tables = generate(sizes, Text(), datetime.utcnow())
+    counts = load(tables, batch_size, report)
+    elapsed = time.time() - started
+    total = sum(counts.values())
+    report('{:<22} {:>10} rows {:>8.1f} s {:>10.0f} rows/s'.format('total', total, elapsed, total / elapsed))
+
+    # the in-process indexes of running workers know nothing of the new rows
+    reset_logs(table.name for table in db.metadata.sorted_tables)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='database URI, the configured one by default')
+    parser.add_argument('--buildings', type=int, default=10000)
+    parser.add_argument('--architects', type=int, default=1000)
+    parser.add_argument('--styles', type=int, default=50)
+    parser.add_argument('--elements', type=int, default=200)
+    parser.add_argument('--stations', type=int, default=250)
+    parser.add_argument('--routes', type=int, default=15)
+    parser.add_argument('--districts', type=int, default=125)
+    parser.add_argument('--regions', type=int, default=12)
+    parser.add_argument('--batch', type=int, default=10000, help='rows per insert')
+    parser.add_argument('--seed', type=int, help='for the same data every time')
+    args = parser.parse_args()
+
+    if args.db:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    random.seed(args.seed)
+
+    with app.app_context():
+        seed(args, args.batch)
+
+
+if __name__ == '__main__':
+    main()
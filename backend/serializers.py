@@ -0,0 +1,77 @@
+from sqlalchemy import Date, DateTime, inspect
+
+
+def _date(value):
+    return str(value) if value is not None else None
+
+
+def _loaded(attr):
+    return 'd[{!r}]'.format(attr)
+
+
+def _instrumented(attr):
+    return 'getattr(obj, {!r})'.format(attr)
+
+
+class Serializer:
+    """Turns instances of one model into dicts with a fixed set of keys.
+
+    `fields` maps output keys to attribute names (or to callables taking the instance) and defaults
+    to all columns of the model; `relations` maps relationship names to a callable applied to every
+    related object, usually the serializer of the related model.
+
+    Everything is worked out once: the serializer is compiled into a function building the dict
+    literally, reading loaded values straight from the instance __dict__ and going through the
+    instrumented attributes only when something has to be loaded first.
+    """
+
+    def __init__(self, cls, fields=None, relations=None):
+        mapper = inspect(cls)
+
+        if fields is None:
+            fields = [prop.key for prop in mapper.column_attrs]
+        if not isinstance(fields, dict):
+            fields = {name: name for name in fields}
+        relations = relations or {}
+
+        self.cls = cls
+        self.fields = fields
+        self.relations = relations
+
+        # (output key, expression given how an attribute is read)
+        items = []
+        namespace = {'_date': _date}
+
+        for i, (key, attr) in enumerate(fields.items()):
+            if not isinstance(attr, str):
+                namespace['_compute%d' % i] = attr
+                items.append((key, lambda read, i=i: '_compute%d(obj)' % i))
+            elif attr in mapper.column_attrs and \
+                    isinstance(mapper.column_attrs[attr].columns[0].type, (Date, DateTime)):
+                items.append((key, lambda read, attr=attr: '_date({})'.format(read(attr))))
+            else:
+                items.append((key, lambda read, attr=attr: read(attr)))
+
+        for i, (name, serialize) in enumerate(relations.items()):
+            namespace['_serialize%d' % i] = serialize
+            if mapper.relationships[name].uselist:
+                items.append((name, lambda read, i=i, name=name:
+                              '[_serialize{}(item) for item in {}]'.format(i, read(name))))
+            else:
+                items.append((name, lambda read, i=i, name=name:
+                              '_serialize{0}({1}) if {1} is not None else None'.format(i, read(name))))
+
+        source = ''
+        for function, read in (('fast', _loaded), ('slow', _instrumented)):
+            source += 'def {}(obj):\n    d = obj.__dict__\n    return {{{}}}\n\n'.format(
+                function, ', '.join('{!r}: {}'.format(key, expression(read)) for key, expression in items))
+
+        exec(source, namespace)
+        self._fast = namespace['fast']
+        self._slow = namespace['slow']
+
+    def __call__(self, obj):
+        try:
+            return self._fast(obj)
+        except KeyError:
+            return self._slow(obj)
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import os.path as op
+import re
+from functools import partial
+
+from sqlalchemy import inspect
+
+from backend.database import db
+
+# Uploads are stored under the SHA-256 of their content, in two levels of directories named after
+# its first four hex digits: ab/cd/abcd...ef.jpg. Equal files are stored once, and as a name never
+# gets another content, the files can be cached by clients forever.
+
+CONTENT_NAME = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(\.|$)')
+
+_EXTENSIONS = {
+    '.jpeg': '.jpg',
+    '.jpe': '.jpg',
+    '.tif': '.tiff',
+}
+
+
+def is_content_name(filename):
+    return CONTENT_NAME.match(filename) is not None
+
+
+def _name(digest, extension):
+    extension = extension.lower()
+    extension = _EXTENSIONS.get(extension, extension)
+    return '{}/{}/{}{}'.format(digest[:2], digest[2:4], digest, extension)
+
+
+def _digest(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(partial(stream.read, 64 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_name(file_data):
+    """The name an upload (a werkzeug FileStorage) is stored under."""
+    file_data.stream.seek(0)
+    digest = _digest(file_data.stream)
+    file_data.stream.seek(0)
+    return _name(digest, op.splitext(file_data.filename)[1])
+
+
+def file_content_name(path):
+    with open(path, 'rb') as f:
+        return _name(_digest(f), op.splitext(path)[1])
+
+
+def store(path, save):
+    """Stores a file at `path` unless it's there already, calling `save` with the path to write to.
+    Returns whether the file was new."""
+    if op.exists(path):
+        return False
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    # a file is complete once it has its name, others may be reading the same name right away
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def image_columns():
+    """(model, column name) of every column holding the name of an uploaded image."""
+    for cls in db.Model.__subclasses__():
+        keys = {prop.key for prop in inspect(cls).column_attrs}
+        for key in sorted(keys):
+            if key + '_srcset' in keys:
+                yield cls, key
+
+
+def references(filename):
+    """The number of rows whose images are stored in `filename`, as saved in the database."""
+    with db.session.no_autoflush:
+        return sum(cls.query.filter(getattr(cls, column) == filename).count() for cls, column in image_columns())
+
+
+def find_processed(filename):
+    """The srcset and placeholder data already made for the image in `filename`, if any."""
+    with db.session.no_autoflush:
+        for cls, column in image_columns():
+            srcset = getattr(cls, column + '_srcset')
+            row = db.session.query(srcset, getattr(cls, column + '_meta')) \
+                .filter(getattr(cls, column) == filename, srcset.isnot(None)).first()
+            if row is not None:
+                return tuple(row)
+    return None
@@ -0,0 +1,152 @@
+import json
+import logging
+from collections import OrderedDict
+from functools import wraps
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from backend.database import db
+
+# Opt-in with TIMING = True: every request counts its queries, the rows they load and the time spent in SQL,
+# in bringing in-process indexes up to date, in serializers and in encoding JSON. What is left of the total
+# is mostly the ORM making objects of the rows. The figures go out in a Server-Timing header (shown by the network tab
+# of browsers), and requests slower than SLOW_REQUEST_MS are logged as a line of JSON with their costliest
+# statements.
+
+logger = logging.getLogger('backend.timing')
+
+
+class Timings:
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.sql = 0.0
+        self.index = 0.0
+        self.serialize = 0.0
+        self.json = 0.0
+        # statement -> [executions, seconds]
+        self.statements = OrderedDict()
+
+    def add_query(self, statement, elapsed):
+        self.queries += 1
+        self.sql += elapsed
+        stats = self.statements.setdefault(statement, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+
+    def header(self, total):
+        return ', '.join([
+            'sql;dur={:.1f};desc="{} queries, {} rows"'.format(self.sql * 1000, self.queries, self.rows),
+            'index;dur={:.1f}'.format(self.index * 1000),
+            'serialize;dur={:.1f}'.format(self.serialize * 1000),
+            'json;dur={:.1f}'.format(self.json * 1000),
+            'total;dur={:.1f}'.format(total * 1000),
+        ])
+
+    def record(self, response, total, statements):
+        costliest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:statements]
+        return OrderedDict([
+            ('method', request.method),
+            ('path', request.full_path if request.query_string else request.path),
+            ('endpoint', request.endpoint),
+            ('status', response.status_code),
+            ('ms', round(total * 1000, 1)),
+            ('sql_ms', round(self.sql * 1000, 1)),
+            ('queries', self.queries),
+            ('rows', self.rows),
+            ('index_ms', round(self.index * 1000, 1)),
+            ('serialize_ms', round(self.serialize * 1000, 1)),
+            ('json_ms', round(self.json * 1000, 1)),
+            ('statements', [
+                OrderedDict([('ms', round(elapsed * 1000, 1)), ('count', count), ('sql', statement)])
+                for statement, (count, elapsed) in costliest
+            ]),
+        ])
+
+
+def _timings():
+    return g.get('timings') if has_request_context() else None
+
+
+def timed(name, function):
+    """`function` adding its time to the `name` of the request timings, less the SQL it runs."""
+    timings = _timings()
+    if timings is None:
+        return function
+
+    @wraps(function)
+    def _timed(*args, **kwargs):
+        sql = timings.sql
+        started = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            setattr(timings, name, getattr(timings, name) + perf_counter() - started - (timings.sql - sql))
+
+    return _timed
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _timings() is not None:
+        conn.info.setdefault('timing_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings()
+    started = conn.info.get('timing_started')
+    if timings is not None and started:
+        timings.add_query(statement, perf_counter() - started.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    started = context.connection.info.get('timing_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+@event.listens_for(db.Model, 'load', propagate=True)
+def _on_load(obj, context):
+    timings = _timings()
+    if timings is not None:
+        timings.rows += 1
+
+
+def init_app(app):
+    if app.config['SLOW_REQUEST_LOG']:
+        handler = logging.FileHandler(app.config['SLOW_REQUEST_LOG'])
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+
+    encoder = app.json_encoder
+
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            return timed('json', super(TimedJSONEncoder, self).encode)(o)
+
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def _start_timing():
+        if app.config['TIMING']:
+            g.timings = Timings()
+
+    @app.after_request
+    def _report_timing(response):
+        timings = g.pop('timings', None)
+        if timings is None:
+            return response
+
+        total = perf_counter() - timings.started
+        response.headers['Server-Timing'] = timings.header(total)
+        if total * 1000 >= app.config['SLOW_REQUEST_MS']:
+            logger.warning(json.dumps(timings.record(response, total, app.config['SLOW_REQUEST_STATEMENTS']),
+                                      ensure_ascii=False))
+        return response
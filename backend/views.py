@@ -1,25 +1,32 @@
 import os
 import os.path as op
-from base64 import b64encode
 from datetime import datetime
 
 from flask import abort, redirect, request, url_for
 
 from flask_security import current_user
 
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.model.form import InlineFormAdmin
-from flask_admin.form.upload import ImageUploadField, FileUploadField
 from markupsafe import Markup
 
+from backend.database import db
 from backend.models import BuildingImage, BuildingNumberFact, BuildingTextFact, ArchitectFact, ElementPlace, \
-    ElementExample, Style
-from backend.fields import CKTextAreaField
+    ElementExample, Style, ImageJob
+from backend.fields import CKTextAreaField, DerivativesFileUploadField, DerivativesImageUploadField
 
 images_path = op.join(op.dirname(__file__), '../images/uploads')
 
 
+def excluded_columns(*images):
+    # columns filled in by the app rather than by editors: versions and what is made of uploaded images
+    return ('updated_at',) + tuple(image + suffix for image in images for suffix in ('_srcset', '_meta'))
+
+
 class CustomModelView(ModelView):
+    form_excluded_columns = excluded_columns()
+
     def _handle_view(self, name, **kwargs):
         if not self.is_accessible():
             if current_user.is_authenticated:
@@ -47,21 +54,19 @@ class UserModelView(CustomModelView):
         return is_accessible('user')
 
 
-def gen_filename(filename):
-    ext = filename.split('.')[-1]
-    filename = b64encode(str(datetime.now()).encode()).decode() + '.' + ext
-    return filename
+class CustomInlineFormAdmin(InlineFormAdmin):
+    form_excluded_columns = excluded_columns()
 
 
-class BuildingImageView(InlineFormAdmin):
+class BuildingImageView(CustomInlineFormAdmin):
+    form_excluded_columns = excluded_columns('path')
     form_overrides = {
-        'path': ImageUploadField,
+        'path': DerivativesImageUploadField,
     }
     form_args = {
         'path': {
             'base_path': images_path,
             'url_relative_path': 'images/uploads/',
-            'namegen': lambda u, v: gen_filename(v.filename),
         }
 
     }
@@ -100,19 +105,20 @@ class BuildingView(UserModelView):
 
     form_overrides = {
         'text': CKTextAreaField,
-        'leading_img_path': ImageUploadField,
+        'leading_img_path': DerivativesImageUploadField,
     }
 
     form_args = {
         'leading_img_path': {
             'base_path': images_path,
             'url_relative_path': 'images/uploads/',
-            'namegen': lambda u, v: gen_filename(v.filename),
         }
     }
 
-    inline_models = (BuildingTextFact,
-                     BuildingNumberFact,
+    form_excluded_columns = excluded_columns('leading_img_path')
+
+    inline_models = (CustomInlineFormAdmin(BuildingTextFact),
+                     CustomInlineFormAdmin(BuildingNumberFact),
                      BuildingImageView(BuildingImage))
 
     create_template = 'admin/create.html'
@@ -130,16 +136,18 @@ class ArchitectView(UserModelView):
         'died'
     )
 
-    inline_models = (ArchitectFact,)
+    form_excluded_columns = excluded_columns('img_path', 'square_img', 'landscape_img', 'portrait_img')
+
+    inline_models = (CustomInlineFormAdmin(ArchitectFact),)
 
     create_template = 'admin/create.html'
     edit_template = 'admin/edit.html'
 
     form_overrides = {
-        'img_path': ImageUploadField,
-        'square_img': ImageUploadField,
-        'landscape_img': ImageUploadField,
-        'portrait_img': ImageUploadField,
+        'img_path': DerivativesImageUploadField,
+        'square_img': DerivativesImageUploadField,
+        'landscape_img': DerivativesImageUploadField,
+        'portrait_img': DerivativesImageUploadField,
 
         'text': CKTextAreaField
     }
@@ -152,7 +160,6 @@ class ArchitectView(UserModelView):
     _img_args = {
         'base_path': images_path,
         'url_relative_path': '/images/uploads/',
-        'namegen': lambda u, v: gen_filename(v.filename),
     }
 
     form_args = {
@@ -170,15 +177,15 @@ def image_column_formatter(_id, path, big=False):
                   .format(_id, '/images/uploads/' + path, '75%' if big else '30%'))
 
 
-class ElementExampleView(InlineFormAdmin):
+class ElementExampleView(CustomInlineFormAdmin):
+    form_excluded_columns = excluded_columns('img_path')
     form_overrides = {
-        'img_path': ImageUploadField,
+        'img_path': DerivativesImageUploadField,
     }
     form_args = {
         'img_path': {
             'base_path': images_path,
             'url_relative_path': 'images/uploads/',
-            'namegen': lambda u, v: gen_filename(v.filename),
         }
 
     }
@@ -192,16 +199,17 @@ class ElementView(UserModelView):
         'img_path'
     )
 
-    inline_models = (ElementPlace, ElementExampleView(ElementExample))
+    form_excluded_columns = excluded_columns('img_path')
+
+    inline_models = (CustomInlineFormAdmin(ElementPlace), ElementExampleView(ElementExample))
 
     form_overrides = {
         'text': CKTextAreaField,
-        'img_path': FileUploadField
+        'img_path': DerivativesFileUploadField
     }
 
     form_args = {
         'img_path': {
-            'namegen': lambda u, v: gen_filename(v.filename),
             'base_path': images_path,
         }
     }
@@ -239,15 +247,16 @@ class StyleView(UserModelView):
         'following'
     )
 
+    form_excluded_columns = excluded_columns('building_img_path', 'door_handle_img_path', 'column_img_path')
+
     form_overrides = {
         'text': CKTextAreaField,
-        'building_img_path': FileUploadField,
-        'column_img_path': FileUploadField,
-        'door_handle_img_path': FileUploadField,
+        'building_img_path': DerivativesFileUploadField,
+        'column_img_path': DerivativesFileUploadField,
+        'door_handle_img_path': DerivativesFileUploadField,
     }
 
     _img_args = {
-        'namegen': lambda u, v: gen_filename(v.filename),
         'base_path': images_path,
     }
 
@@ -343,3 +352,28 @@ class MetroRouteView(UserModelView):
 
 class UserView(SuperuserModelView):
     column_exclude_list = ('password',)
+
+
+class ImageJobView(UserModelView):
+    can_create = False
+    can_edit = False
+    column_default_sort = ('id', True)
+    column_list = (
+        'id',
+        'target_table',
+        'target_id',
+        'target_column',
+        'filename',
+        'status',
+        'attempts',
+        'run_after',
+        'error',
+        'updated_at',
+    )
+    column_filters = ('status', 'target_table')
+
+    @action('retry', 'Retry')
+    def action_retry(self, ids):
+        ImageJob.query.filter(ImageJob.id.in_(ids), ImageJob.status != 'running').update(
+            {'status': 'pending', 'attempts': 0, 'run_after': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
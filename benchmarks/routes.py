@@ -0,0 +1,264 @@
+"""Times every /api route and the to_dict of every model on generated data of several sizes.
+
+    python -m benchmarks.routes [--db URI] [--sizes N,N,...] [--repeat N] [--save FILE] [--compare FILE]
+
+The database is seeded by backend.seed for each size (the number of buildings, the other tables grow
+along), so it is dropped: point --db at a scratch one. For every route the latency percentiles, the SQL
+queries per request and the peak memory allocated by a request are reported; for to_dict, the time per row
+and the memory for --rows rows. Responses are built every time, the response cache is emptied before each
+request unless --cached is given.
+
+--save writes the results as a baseline, --compare reports the change from one and exits with 1 when
+a route got slower by more than --threshold or makes more queries than it did.
+"""
+import argparse
+import json
+import math
+import os.path as op
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from backend import app, db
+
+DEFAULT_DB = 'sqlite:///' + op.join(tempfile.gettempdir(), 'architeacher-benchmark.sqlite')
+
+# the collections returned whole get slow with the size, they are requested fewer times
+WHOLE_REPEAT = 5
+
+queries = [0]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count(*args):
+    queries[0] += 1
+
+
+def sizes(buildings):
+    # the proportions of backend.seed defaults
+    return Namespace(buildings=buildings, architects=max(10, buildings // 10), styles=50,
+                     elements=max(20, buildings // 50), stations=250, routes=15, districts=125, regions=12)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def sample_ids(cls, count):
+    ids = [_id for _id, in db.session.query(cls.id)]
+    return random.sample(ids, min(count, len(ids)))
+
+
+def sample_terms(cls, column, count):
+    terms = []
+    for _id in sample_ids(cls, count):
+        text = getattr(cls.query.get(_id), column) or ''
+        length = min(len(text), random.randint(3, 6))
+        start = random.randint(0, len(text) - length)
+        terms.append(text[start:start + length])
+    db.session.remove()
+    return [term for term in terms if term]
+
+
+def requests(mapping, repeat):
+    """(name, times to run, request) of every route, a request being a function of the test client."""
+    cases = []
+    with app.app_context():
+        for endpoint, val in mapping.items():
+            cls = val['class']
+            url = '/api/' + endpoint
+            ids = sample_ids(cls, repeat)
+            terms = sample_terms(cls, val['search'], repeat)
+            batch = sample_ids(cls, 20)
+            db.session.remove()
+
+            cases += [
+                (endpoint + '.all', WHOLE_REPEAT, lambda c, url=url: c.get(url)),
+                (endpoint + '.page', repeat, lambda c, url=url: c.get(url + '?limit=50')),
+                (endpoint + '.one', repeat, lambda c, url=url, ids=ids: c.get(
+                    '{}/{}'.format(url, random.choice(ids)))),
+                (endpoint + '.random', repeat, lambda c, url=url: c.get(url + '/random')),
+                (endpoint + '.batch', repeat, lambda c, url=url, batch=batch: c.post(url + '/batch', data=json.dumps(
+                    {'ids': batch}), content_type='application/json')),
+            ]
+            if terms:
+                cases.append((endpoint + '.search', repeat, lambda c, url=url, key=val['search'], terms=terms: c.get(
+                    url, query_string={key: random.choice(terms)})))
+
+    def bbox(lat, lon, half):
+        return '{},{},{},{}'.format(lon - half * 2, lat - half, lon + half * 2, lat + half)
+
+    from backend.seed import CENTRE
+    lat, lon = CENTRE
+    cases += [
+        ('buildings.within', repeat, lambda c: c.get('/api/buildings/within', query_string={
+            'bbox': bbox(lat + random.uniform(-0.05, 0.05), lon + random.uniform(-0.1, 0.1), 0.01), 'limit': 100})),
+        ('buildings.nearest', repeat, lambda c: c.get('/api/buildings/nearest', query_string={
+            'lat': lat + random.uniform(-0.1, 0.1), 'lon': lon + random.uniform(-0.2, 0.2), 'k': 20})),
+        ('buildings.clusters', repeat, lambda c: c.get('/api/buildings/clusters', query_string={
+            'bbox': bbox(lat, lon, 0.2), 'zoom': random.randint(8, 14)})),
+        ('buildings.facets', repeat, lambda c: c.get('/api/buildings/facets', query_string=random.choice([
+            {'district': random.randint(1, 125), 'limit': 20},
+            {'style': '{},{}'.format(random.randint(1, 50), random.randint(1, 50)), 'limit': 20},
+            {'region': random.randint(1, 12), 'year_from': random.randint(1700, 2000), 'limit': 20},
+        ]))),
+        ('styles.timeline', WHOLE_REPEAT, lambda c: c.get('/api/styles/timeline')),
+        ('metro.graph', WHOLE_REPEAT, lambda c: c.get('/api/metro/graph')),
+    ]
+    return cases
+
+
+def measure(client, clear, name, times, request):
+    request(client)  # indexes are built by the first request
+
+    latencies = []
+    counts = []
+    for _ in range(times):
+        clear()
+        queries[0] = 0
+        started = time.perf_counter()
+        response = request(client)
+        latencies.append(time.perf_counter() - started)
+        counts.append(queries[0])
+        if response.status_code != 200:
+            raise RuntimeError('{}: {} {}'.format(name, response.status_code, response.get_data(as_text=True)))
+
+    clear()
+    tracemalloc.start()
+    request(client)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result(latencies, sum(counts) / len(counts), peak)
+
+
+def measure_to_dict(mapping, rows, repeat):
+    results = {}
+    with app.app_context():
+        for endpoint, val in mapping.items():
+            cls = val['class']
+            # everything loaded up front, so only serialization is timed
+            items = cls.query.options(*val['load'].values()).filter(cls.id.in_(sample_ids(cls, rows))).all()
+            if not items:
+                continue
+            for item in items:
+                item.to_dict()
+
+            latencies = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                for item in items:
+                    item.to_dict()
+                latencies.append((time.perf_counter() - started) / len(items))
+
+            tracemalloc.start()
+            for item in items:
+                item.to_dict()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results[endpoint + '.to_dict'] = result(latencies, 0, peak)
+            db.session.remove()
+    return results
+
+
+def result(latencies, queries, peak):
+    return {
+        'p50': percentile(latencies, 50) * 1000,
+        'p90': percentile(latencies, 90) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': max(latencies) * 1000,
+        'queries': queries,
+        'peak_kb': peak / 1024,
+    }
+
+
+def compare(current, baseline, threshold):
+    """The change of p50 from the baseline, and whether it is a regression."""
+    if baseline is None:
+        return '', False
+    change = current['p50'] / baseline['p50'] - 1 if baseline['p50'] else 0
+    regressed = change > threshold or current['queries'] > baseline['queries']
+    return '{:+.0%}{}'.format(change, ' !' if regressed else ''), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=DEFAULT_DB, help='scratch database URI, dropped and seeded for each size')
+    parser.add_argument('--sizes', default='1000,10000', help='numbers of buildings to seed, comma separated')
+    parser.add_argument('--repeat', type=int, default=50, help='requests per route')
+    parser.add_argument('--rows', type=int, default=500, help='rows serialized by to_dict')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cached', action='store_true', help='keep the response cache, i.e. time cache hits')
+    parser.add_argument('--save', help='file to save the results to, as a baseline')
+    parser.add_argument('--compare', help='baseline file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='slowdown of p50 counted as a regression')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+
+    from backend.routes import mapping, response_cache
+    from backend.seed import seed
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['sizes']
+
+    clear = (lambda: None) if args.cached else response_cache.rebuild
+    client = app.test_client()
+    results = {}
+    regressions = []
+
+    for size in map(int, args.sizes.split(',')):
+        random.seed(args.seed)
+        with app.app_context():
+            seed(sizes(size), report=lambda line: None)
+            dialect = db.engine.dialect.name
+
+        print('\n{} buildings'.format(size))
+        print('{:<26} {:>9} {:>9} {:>9} {:>9} {:>8} {:>9} {:>8}'.format(
+            'route', 'p50, ms', 'p90, ms', 'p99, ms', 'max, ms', 'queries', 'peak, KB', 'vs base'))
+
+        current = {}
+        for name, times, request in requests(mapping, args.repeat):
+            current[name] = measure(client, clear, name, times, request)
+        current.update(measure_to_dict(mapping, args.rows, args.repeat))
+
+        for name, r in current.items():
+            change, regressed = compare(r, baseline.get(str(size), {}).get(name), args.threshold)
+            if regressed:
+                regressions.append('{} buildings: {}'.format(size, name))
+            print('{:<26} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f} {:>9.0f} {:>8}'.format(
+                name, r['p50'], r['p90'], r['p99'], r['max'], r['queries'], r['peak_kb'], change))
+        results[str(size)] = current
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': datetime.utcnow().isoformat(),
+                'database': dialect,
+                'python': platform.python_version(),
+                'cached': args.cached,
+                'repeat': args.repeat,
+                'sizes': results,
+            }, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('\nregressions (p50 more than {:.0%} slower, or more queries):'.format(args.threshold))
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
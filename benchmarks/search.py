@@ -0,0 +1,64 @@
+"""Compares the trigram SearchIndex with the LIKE '%term%' scan it replaced.
+
+    python -m benchmarks.search [--db URI] [--terms N] [--repeat N]
+"""
+import argparse
+import random
+import timeit
+
+from backend import app, db
+from backend.search import SearchIndex
+
+
+def sample_terms(index, count):
+    texts = [text for texts in index.texts.values() for text in texts if text]
+    terms = []
+    for text in random.sample(texts, min(count, len(texts))):
+        length = random.randint(1, min(len(text), 8))
+        start = random.randint(0, len(text) - length)
+        terms.append(text[start:start + length])
+    return terms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='database URI, the configured one by default')
+    parser.add_argument('--terms', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.db:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+
+    from backend.routes import mapping
+
+    with app.app_context():
+        print('{:<16} {:>10} {:>12} {:>12} {:>8}'.format('endpoint', 'build, ms', 'LIKE, ms', 'index, ms', 'speedup'))
+
+        for endpoint, val in mapping.items():
+            cls = val['class']
+            column = getattr(cls, val['search'])
+            index = SearchIndex(cls, val.get('search_columns', [column]))
+
+            build = timeit.timeit(index.refresh, number=1)
+            terms = sample_terms(index, args.terms)
+            if not terms:
+                continue
+
+            def like():
+                for term in terms:
+                    db.session.query(cls.id).filter(column.like('%' + term + '%')).all()
+
+            def search():
+                for term in terms:
+                    index.search(term)
+
+            like_time = min(timeit.repeat(like, number=1, repeat=args.repeat)) / len(terms)
+            search_time = min(timeit.repeat(search, number=1, repeat=args.repeat)) / len(terms)
+
+            print('{:<16} {:>10.1f} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                endpoint, build * 1000, like_time * 1000, search_time * 1000, like_time / search_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Compares the compiled serializers with the __dict__-walking to_dict methods they replaced.
+
+    python -m benchmarks.serializers [--db URI] [--repeat N]
+"""
+import argparse
+import timeit
+from datetime import date
+
+from backend import app
+from backend.models import Building, Architect, Style, Element
+
+
+# the to_dict implementations as they were before backend.serializers
+
+def dictonify(d, exclude=None):
+    if exclude is None:
+        exclude = ['_sa_instance_state']
+    return {
+        k: v if not isinstance(v, date) else str(v) if v is not None else None
+        for k, v
+        in d.items()
+        if k not in exclude and not isinstance(v, list)
+    }
+
+
+def building_to_dict(self):
+    result = dictonify(self.__dict__)
+    result.update({
+        'images': [{'id': image.id, 'name': image.name, 'path': image.path} for image in self.images],
+        'architects': [{'id': architect.id, 'name': architect.surname} for architect in self.architects],
+        'styles': [{'id': style.id, 'name': style.name, 'path': style.building_img_path} for style in self.styles],
+        'number_facts': [{'id': fact.id, 'number': fact.number, 'name': fact.name} for fact in self.number_facts],
+        'text_facts': [{'id': fact.id, 'text': fact.text} for fact in self.text_facts],
+    })
+    return result
+
+
+def architect_to_dict(self):
+    result = dictonify(self.__dict__)
+    result.update({
+        'styles': [{'id': style.id, 'name': style.name} for style in self.styles],
+        'buildings': [
+            {'id': building.id, 'title': building.title, 'title_info': building.title_info,
+             'path': building.leading_img_path} for building in self.buildings
+        ],
+        'facts': [dictonify(fact.__dict__) for fact in self.facts],
+    })
+    return result
+
+
+def style_to_dict(self):
+    result = dictonify(self.__dict__)
+    result.update({
+        'following_id': self.following.id if self.following else None,
+        'architects': [
+            {'id': architect.id, 'surname': architect.surname, 'patronymic': architect.patronymic,
+             'name': architect.name, 'path': architect.img_path} for architect in self.architects
+        ],
+        'buildings': [
+            {'id': building.id, 'title': building.title, 'title_info': building.title_info,
+             'path': building.leading_img_path} for building in self.buildings
+        ],
+        'elements': [
+            {'id': element.id, 'name': element.name, 'description': element.description,
+             'path': element.img_path} for element in self.elements
+        ],
+    })
+    return result
+
+
+def element_to_dict(self):
+    result = dictonify(self.__dict__)
+    result.update({
+        'styles': [{'id': style.id, 'name': style.name} for style in self.styles],
+        'places': [{'id': place.id, 'name': place.name} for place in self.places],
+        'examples': [
+            {'id': example.id, 'img_path': example.img_path,
+             'building': {'id': example.building.id, 'title': example.building.title,
+                          'title_info': example.building.title_info}} for example in self.examples
+        ],
+    })
+    return result
+
+
+legacy = {
+    Building: building_to_dict,
+    Architect: architect_to_dict,
+    Style: style_to_dict,
+    Element: element_to_dict,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='database URI, the configured one by default')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.db:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+
+    from backend.routes import mapping
+
+    with app.app_context():
+        print('{:<12} {:>6} {:>16} {:>16} {:>8}'.format('model', 'rows', 'to_dict, us/row', 'compiled, us/row',
+                                                        'speedup'))
+
+        for val in mapping.values():
+            cls = val['class']
+            if cls not in legacy:
+                continue
+
+            # everything loaded up front, so only serialization is timed
+            items = cls.query.options(*val['load'].values()).all()
+            if not items:
+                continue
+            for item in items:
+                legacy[cls](item)
+
+            def old():
+                for item in items:
+                    legacy[cls](item)
+
+            def new():
+                for item in items:
+                    item.to_dict()
+
+            old_time = min(timeit.repeat(old, number=1, repeat=args.repeat)) / len(items)
+            new_time = min(timeit.repeat(new, number=1, repeat=args.repeat)) / len(items)
+
+            print('{:<12} {:>6} {:>16.2f} {:>16.2f} {:>7.1f}x'.format(
+                cls.__name__, len(items), old_time * 1e6, new_time * 1e6, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Load-tests gunicorn with each worker class of gunicorn_conf.py, to compare their throughput.
+
+    python -m benchmarks.serving [--db URI] [--worker-classes sync,gevent] [--workers N] [--concurrency N]
+                                 [--duration SECONDS]
+
+The servers are started one after the other with gunicorn_conf.py on the same database (seed it with
+backend.seed first) and get the same mix of /api requests from --concurrency clients. Unless --cached
+is given, every request carries an unused parameter, so that the response cache misses and the database
+is queried. The gevent workers only pay off on PostgreSQL: SQLite blocks the whole worker.
+"""
+import argparse
+import http.client
+import math
+import os
+import os.path as op
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+
+_app = []
+
+
+def wsgi(environ, start_response):
+    # the app of the gunicorn workers started by main(), on the database given to them
+    if not _app:
+        from backend import app
+        if os.environ.get('BENCHMARK_DB'):
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['BENCHMARK_DB']
+        from backend import routes
+        _app.append(app)
+    return _app[0](environ, start_response)
+
+
+def urls(db):
+    """Functions making the URLs of the requests, each as likely as the other."""
+    from backend import app
+    from backend.database import db as _db
+    from backend.models import Building, Architect, Style
+
+    if db:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db
+    with app.app_context():
+        ids = {cls: [_id for _id, in _db.session.query(cls.id)] for cls in (Building, Architect, Style)}
+
+    return [
+        lambda: '/api/buildings/{}'.format(random.choice(ids[Building])),
+        lambda: '/api/buildings/{}?fields=title,address&embed=architects'.format(random.choice(ids[Building])),
+        lambda: '/api/architects/{}'.format(random.choice(ids[Architect])),
+        lambda: '/api/styles/{}?embed='.format(random.choice(ids[Style])),
+        lambda: '/api/buildings/random',
+        lambda: '/api/buildings?limit=20',
+        lambda: '/api/buildings/nearest?lat={:.5f}&lon={:.5f}&k=10'.format(
+            random.gauss(55.75, 0.05), random.gauss(37.62, 0.1)),
+    ]
+
+
+def serve(worker_class, workers, db, port, log):
+    env = dict(os.environ, WORKER_CLASS=worker_class, BENCHMARK_DB=db or '')
+    if workers:
+        env['WORKERS'] = str(workers)
+    env.pop('WORKER_CONNECTIONS', None)
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', op.join(ROOT, 'gunicorn_conf.py'),
+                             '--chdir', ROOT, '--bind', '127.0.0.1:{}'.format(port),
+                             '--access-logfile', os.devnull, '--error-logfile', '-', 'benchmarks.serving:wsgi'],
+                            env=env, cwd=ROOT, stdout=log, stderr=log)
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def load(port, make_urls, concurrency, duration, cached):
+    """Requests from `concurrency` threads for `duration` seconds, returns the latencies and the errors."""
+    latencies = []
+    errors = [0]
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            url = random.choice(make_urls)()
+            if not cached:
+                url += ('&' if '?' in url else '?') + 'nocache={}'.format(random.getrandbits(64))
+            started = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                connection.request('GET', url)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)] if samples else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='database URI, the configured one by default')
+    parser.add_argument('--worker-classes', default='sync,gevent')
+    parser.add_argument('--workers', type=int, help='workers of every server, as gunicorn_conf.py picks by default')
+    parser.add_argument('--concurrency', type=int, default=50, help='clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per server')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--cached', action='store_true', help='let the response cache answer repeated requests')
+    args = parser.parse_args()
+
+    make_urls = urls(args.db)
+
+    print('{:<8} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'workers', 'requests', 'req/s', 'p50, ms', 'p90, ms', 'p99, ms', 'errors'))
+
+    for worker_class in args.worker_classes.split(','):
+        with tempfile.TemporaryFile() as log:
+            server = serve(worker_class, args.workers, args.db, args.port, log)
+            try:
+                if not wait_for(args.port):
+                    log.seek(0)
+                    sys.exit('{} workers did not start:\n{}'.format(worker_class, log.read().decode()))
+                # the workers import the app and build their indexes on their first requests
+                load(args.port, make_urls, args.concurrency, args.warmup, args.cached)
+                latencies, errors = load(args.port, make_urls, args.concurrency, args.duration, args.cached)
+            finally:
+                server.terminate()
+                server.wait()
+
+        print('{:<8} {:>8} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8}'.format(
+            worker_class, len(latencies), len(latencies) / args.duration, percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
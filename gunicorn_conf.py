@@ -1,8 +1,24 @@
 import multiprocessing
 import os
 
+# WORKER_CLASS=gevent serves many requests at once in every worker, waiting for PostgreSQL cooperatively;
+# the default sync workers answer one request each. The app sizes its database pools from these variables.
+worker_class = os.environ.setdefault('WORKER_CLASS', 'sync')
+
 bind = '127.0.0.1:5000'
-workers = multiprocessing.cpu_count() * 2 + 1
+if worker_class == 'gevent':
+    # waits for I/O overlap within a worker, so a worker per core is enough
+    workers = int(os.environ.setdefault('WORKERS', str(multiprocessing.cpu_count() + 1)))
+    worker_connections = int(os.environ.setdefault('WORKER_CONNECTIONS', '100'))
+else:
+    workers = int(os.environ.setdefault('WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
 errorlog = os.path.abspath(os.path.dirname(__file__)) + '/error.log'
 accesslog = os.path.abspath(os.path.dirname(__file__)) + '/access.log'
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" "%({X-Real-IP}i)s"'
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits for the database in C, where gevent can't switch to other requests
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,52 @@
+import unittest
+
+from backend import clusters
+from backend.clusters import ClusterIndex, project
+from backend.models import Building
+
+MAX_ZOOM = 18
+
+
+def tile_of(point, zoom):
+    x, y = project(*point)
+    return int(x * (1 << zoom)), int(y * (1 << zoom))
+
+
+class ClusterTileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ClusterIndex(Building, Building.latitude, Building.longitude, MAX_ZOOM, 64)
+        self.index.points = {}
+        self.index.levels = [{} for _ in range(MAX_ZOOM + 1)]
+        self.index.members = {}
+        # two buildings a few metres apart, one cell at max zoom
+        for _id, point in (1, (55.751, 37.617)), (2, (55.75101, 37.61703)):
+            self.index.points[_id] = point
+            self.index._place(_id, point, 1)
+
+    def test_tile_at_max_zoom(self):
+        x, y = tile_of(self.index.points[1], MAX_ZOOM)
+        clusters = self.index.tile(MAX_ZOOM, x, y)
+        self.assertEqual([cluster['count'] for cluster in clusters], [2])
+
+    def test_tile_above_max_zoom(self):
+        for zoom in range(MAX_ZOOM + 1, MAX_ZOOM + 5):
+            x, y = tile_of(self.index.points[1], zoom)
+            inside = [_id for _id, point in self.index.points.items() if tile_of(point, zoom) == (x, y)]
+            clusters = self.index.tile(zoom, x, y)
+            self.assertEqual(sum(cluster['count'] for cluster in clusters), len(inside))
+            if len(inside) == 1:
+                self.assertEqual([cluster['id'] for cluster in clusters], [1])
+
+    def test_empty_tile_above_max_zoom(self):
+        x, y = tile_of(self.index.points[1], MAX_ZOOM + 2)
+        self.assertEqual(self.index.tile(MAX_ZOOM + 2, x + 3, y + 3), [])
+
+    def test_tile_too_deep(self):
+        self.assertEqual(self.index.tile(10 ** 9, 0, 0), [])
+        x, y = tile_of(self.index.points[1], clusters.MAX_ZOOM)
+        self.assertEqual(len(self.index.tile(clusters.MAX_ZOOM, x, y)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
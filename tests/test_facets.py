@@ -0,0 +1,129 @@
+import random
+import unittest
+from collections import Counter
+
+from backend.facets import FACETS, FacetIndex
+
+# buildings by id: district, station, start, end, styles, architects
+REGIONS = {district: district % 3 + 1 for district in range(1, 8)}
+
+
+def building(generator):
+    start = generator.randint(1800, 1830)
+    return {
+        'district': generator.randint(1, 7),
+        'station': generator.randint(1, 4),
+        'start': start,
+        'end': start + generator.randint(-2, 6),
+        'style': tuple(sorted(generator.sample(range(1, 6), generator.randint(0, 2)))),
+        'architect': tuple(sorted(generator.sample(range(1, 9), generator.randint(0, 3)))),
+    }
+
+
+class FacetSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        generator = random.Random(1)
+        self.buildings = {_id: building(generator) for _id in range(1, 201)}
+        self.index = FacetIndex()
+        self.index.ids = set()
+        self.index.max_id = 0
+        self.index.values = {name: [] for name in ('district', 'station', 'start', 'end', 'style', 'architect')}
+        self.index.postings = {name: {} for name in self.index.values}
+        self.index.together = {}
+        self.index.years = {name: {} for name in ('style', 'architect', 'district', 'station')}
+        self.index.running = None
+        self.index.first_year, self.index.span = 1805, 10
+        self.index.region_of = dict(REGIONS)
+        for _id in self.buildings:
+            self.add(_id)
+
+    def add(self, _id):
+        # the way _load does
+        values = dict(self.buildings[_id], end=max(self.buildings[_id]['start'], self.buildings[_id]['end']))
+        self.index.ids.add(_id)
+        self.index.max_id = max(self.index.max_id, _id)
+        for name, value in values.items():
+            self.index._add(name, _id, value)
+        self.index._count(_id, 1)
+
+    def matches(self, _id, filters):
+        values = self.buildings[_id]
+        if filters.get('year_from', 0) > filters.get('year_to', 10000):
+            return False
+        for name, wanted in filters.items():
+            if name == 'year_from' and max(values['start'], values['end']) < wanted:
+                return False
+            if name == 'year_to' and values['start'] > wanted:
+                return False
+            if name == 'region' and self.index.region_of.get(values['district']) not in wanted:
+                return False
+            if name in ('style', 'architect') and not wanted.intersection(values[name]):
+                return False
+            if name in ('district', 'station') and values[name] not in wanted:
+                return False
+        return True
+
+    def search(self, filters, limit, after):
+        found = sorted(_id for _id in self.buildings if self.matches(_id, filters))
+        facets = {}
+        for facet, own in FACETS.items():
+            others = {name: wanted for name, wanted in filters.items() if name not in own}
+            counts = Counter()
+            for _id in self.buildings:
+                if self.matches(_id, others):
+                    values = self.buildings[_id]
+                    if facet == 'region':
+                        counts[self.index.region_of.get(values['district'])] += 1
+                    elif facet == 'decade':
+                        counts[values['start'] // 10 * 10] += 1
+                    elif facet in ('style', 'architect'):
+                        counts.update(values[facet])
+                    else:
+                        counts[values[facet]] += 1
+            facets[facet] = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return [_id for _id in found if after is None or _id > after][:limit], len(found), facets
+
+    def check(self, filters):
+        for limit, after in (5, None), (200, None), (5, 100):
+            page, count, facets = self.index.search(filters, limit, after)
+            expected = self.search(filters, limit, after)
+            self.assertEqual((page, count), expected[:2], filters)
+            self.assertEqual(facets, expected[2], filters)
+
+    def filters(self):
+        generator = random.Random(2)
+        yield {}
+        for _ in range(200):
+            filters = {}
+            for name, values in (('style', range(1, 6)), ('architect', range(1, 9)), ('district', range(1, 8)),
+                                 ('station', range(1, 5)), ('region', range(1, 4))):
+                if generator.random() < 0.25:
+                    filters[name] = set(generator.sample(values, generator.randint(1, 2)))
+            for name in 'year_from', 'year_to':
+                if generator.random() < 0.3:
+                    filters[name] = generator.randint(1795, 1840)
+            yield filters
+
+    def test_search(self):
+        for filters in self.filters():
+            self.check(filters)
+
+    def test_search_after_changes(self):
+        generator = random.Random(3)
+        for _id in generator.sample(sorted(self.buildings), 50):
+            self.index._remove(_id)
+            del self.buildings[_id]
+        for _id in generator.sample(sorted(self.buildings), 50):
+            self.index._remove(_id)
+            self.buildings[_id] = building(generator)
+            self.buildings[_id]['start'] -= 40
+            self.add(_id)
+        self.index.region_of[1] = 3
+        self.index._count_regions()
+        for filters in self.filters():
+            self.check(filters)
+
+
+if __name__ == '__main__':
+    unittest.main()
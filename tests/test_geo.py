@@ -0,0 +1,36 @@
+import random
+import time
+import unittest
+
+from backend.geo import GeoIndex, distance
+from backend.models import Building
+
+
+class GeoNearestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = GeoIndex(Building, Building.latitude, Building.longitude, 0.01)
+        self.index.points = {}
+        self.index.cells = {}
+        # a few hundred buildings around Moscow
+        generator = random.Random(1)
+        for _id in range(1, 301):
+            point = 55.75 + generator.uniform(-0.3, 0.3), 37.62 + generator.uniform(-0.5, 0.5)
+            self.index.points[_id] = point
+            self.index.cells.setdefault(self.index._key(*point), set()).add(_id)
+
+    def nearest(self, lat, lon, k):
+        return sorted((distance(lat, lon, *point), _id) for _id, point in self.index.points.items())[:k]
+
+    def test_near_the_points(self):
+        self.assertEqual(self.index.nearest(55.7, 37.6, 10), self.nearest(55.7, 37.6, 10))
+
+    def test_far_from_the_points(self):
+        for lat, lon in (0, 0), (-60, -120), (89.9, 37.62):
+            started = time.time()
+            found = self.index.nearest(lat, lon, 10)
+            self.assertLess(time.time() - started, 1)
+            self.assertEqual(found, self.nearest(lat, lon, 10))
+
+    def test_more_than_there_are(self):
+        self.assertEqual(len(self.index.nearest(0, 0, 500)), 300)